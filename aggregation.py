@@ -0,0 +1,57 @@
+import pandas as pd
+import numpy as np
+
+def factorize_keys(*keys):
+    '''Integer codes of several key columns (e.g. Study ID of every source) on one
+    shared, sorted set of labels, so sources can be joined by code.
+    Missing keys are -1. Returns the codes of every column and the labels.'''
+    codes, labels = pd.factorize(pd.concat([pd.Series(np.asarray(key, dtype=object)) for key in keys]), sort=True)
+    bounds = np.cumsum([0] + [len(key) for key in keys])
+    return [codes[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])], labels
+
+class SortedGroups():
+    '''Rows sorted by integer group code once, reductions per group run on contiguous
+    blocks with ufunc.reduceat. Rows with code -1 are left out.
+    Groups are in increasing code order, like groupby(sort=True).'''
+
+    def __init__(self, codes):
+        codes = np.asarray(codes)
+        order = np.argsort(codes, kind="stable")
+        self.order = order[(codes < 0).sum():]
+        sorted_codes = codes[self.order]
+        self.starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(sorted_codes) else np.array([], dtype=int)
+        self.ends = np.r_[self.starts[1:], len(sorted_codes)].astype(int)
+        self.codes = sorted_codes[self.starts]
+
+    def mean(self, values):
+        '''Mean of every column of values (n x columns) per group, skipping NaN like groupby().mean()'''
+        values = np.asarray(values, dtype=float)[self.order]
+        if not len(self.codes):
+            return np.empty((0, values.shape[1]))
+        observed = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(observed, values, 0), self.starts, axis=0)
+        counts = np.add.reduceat(observed, self.starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / counts
+
+    def first_positions(self, missing):
+        '''Position (in the original rows) of the first non-missing value of every column
+        per group, like groupby().first(), -1 where a group has no value.
+        missing is an (n x columns) boolean array.'''
+        missing = np.asarray(missing)[self.order]
+        if not len(self.codes):
+            return np.empty((0, missing.shape[1]), dtype=int)
+        sorted_positions = np.where(missing, len(missing), np.arange(len(missing))[:, None])
+        first = np.minimum.reduceat(sorted_positions, self.starts, axis=0)
+        found = first < self.ends[:, None]
+        return np.where(found, self.order[np.minimum(first, len(missing) - 1)], -1)
+
+def take_first(df, groups):
+    # groupby().first() of every column of df, columns keep their dtype where all groups have a value
+    positions = groups.first_positions(df.isna().to_numpy())
+    columns = {}
+    for i, col in enumerate(df.columns):
+        found = positions[:, i] >= 0
+        column = df[col].iloc[np.where(found, positions[:, i], 0)].reset_index(drop=True)
+        columns[col] = column if found.all() else column.where(found)
+    return pd.DataFrame(columns)
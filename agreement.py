@@ -0,0 +1,119 @@
+import pandas as pd
+import numpy as np
+
+from icc import tensor_from_codes
+
+def bin_edges(X, n_bins):
+    '''Edges of n_bins equally wide bins per column of X (n x items), the same as
+    pd.cut(col, bins=n_bins): the range is widened by 0.1% so the minimum falls in the first bin'''
+    low = np.nanmin(X, axis=0)
+    high = np.nanmax(X, axis=0)
+    constant = low == high
+    adjust = np.where(low != 0, 0.001*np.abs(low), 0.001)
+    low = np.where(constant, low - adjust, low)
+    high = np.where(constant, high + adjust, high)
+
+    edges = np.linspace(low, high, n_bins+1, axis=-1)
+    edges[~constant, 0] -= (high - low)[~constant] * 0.001
+    return edges
+
+def bin_items(X, n_bins):
+    '''Bin codes 0..n_bins-1 of all columns of X at once, bins are closed on the right
+    like pd.cut. Missing values stay NaN.'''
+    X = np.asarray(X, dtype=float)
+    with np.errstate(invalid="ignore"):
+        edges = bin_edges(X, n_bins)
+        # Number of inner edges below the value, the same as np.digitize(right=True) - 1 per column
+        codes = (X[..., None] > edges[:, 1:-1]).sum(axis=-1).astype(float)
+    codes[np.isnan(X)] = np.nan
+    return codes
+
+def subject_positions(subjects):
+    '''Subject codes of a column of a long df, and the position of every row among
+    the rows of its subject (in df order), used as rater codes'''
+    subject_codes, _ = pd.factorize(subjects)
+    order = np.argsort(subject_codes, kind="stable")
+    counts = np.bincount(subject_codes[subject_codes >= 0])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    position = np.full(len(subject_codes), -1)
+    labelled = order[(subject_codes < 0).sum():]
+    position[labelled] = np.arange(len(labelled)) - np.repeat(starts, counts)
+    return subject_codes, position
+
+def ratings_by_subject(df, items, subjects="Subject ID"):
+    '''(subjects x raters x items) array from a long df with one row per rating.
+    The raters of a subject are its rows in df order, subjects with fewer ratings are NaN-padded.'''
+    subject_codes, position = subject_positions(df[subjects])
+    return tensor_from_codes(subject_codes, position, df[items].to_numpy(dtype=float))
+
+def exact_agreement(x):
+    # Share of subjects whose observed ratings are all equal, like groupby().nunique().eq(1)
+    observed = ~np.isnan(x)
+    highest = np.where(observed, x, -np.inf).max(axis=1)
+    lowest = np.where(observed, x, np.inf).min(axis=1)
+    agree = (highest == lowest) & observed.any(axis=1)
+    return agree.sum(axis=0) / len(x)
+
+def mean_abs_delta(x):
+    # Mean absolute difference between consecutive raters of a subject, like groupby().diff()
+    deltas = np.abs(np.diff(x, axis=1))
+    observed = ~np.isnan(deltas)
+    with np.errstate(invalid="ignore"):
+        return np.where(observed, deltas, 0).sum(axis=(0, 1)) / observed.sum(axis=(0, 1))
+
+def weighted_kappa(x):
+    '''Quadratic weighted kappa per item, averaged over all pairs of raters.
+    Per pair, subjects rated by both are used. With quadratic weights the expected
+    disagreement only needs the means and variances of both raters.'''
+    a = x[:, :, None, :]
+    b = x[:, None, :, :]
+    both = ~np.isnan(a) & ~np.isnan(b)
+    n = both.sum(axis=0)
+    a = np.where(both, a, 0)
+    b = np.where(both, b, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_a = a.sum(axis=0) / n
+        mean_b = b.sum(axis=0) / n
+        observed = ((a - b)**2).sum(axis=0) / n
+        expected = (a**2).sum(axis=0)/n - mean_a**2 + (b**2).sum(axis=0)/n - mean_b**2 + (mean_a - mean_b)**2
+        kappa = 1 - observed/expected
+
+        kappa = kappa[np.triu_indices(x.shape[1], 1)]
+        defined = ~np.isnan(kappa)
+        return np.where(defined, kappa, 0).sum(axis=0) / defined.sum(axis=0)
+
+def krippendorff_alpha(x):
+    '''Krippendorff's alpha with the interval metric per item, for any number of raters
+    and missing ratings. Sums of squared differences over all pairs of values are
+    computed from sums and sums of squares, within subjects and over all values.'''
+    observed = ~np.isnan(x)
+    m = observed.sum(axis=1)
+    pairable = m > 1
+    values = np.where(observed & pairable[:, None, :], x, 0)
+
+    s1 = values.sum(axis=1)
+    s2 = (values**2).sum(axis=1)
+    n_values = np.where(pairable, m, 0).sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        within = np.where(pairable, (m*s2 - s1**2) / (m - 1), 0).sum(axis=0)
+        total = n_values*s2.sum(axis=0) - s1.sum(axis=0)**2
+        return 1 - (n_values - 1) * within / total
+
+def agreement_table(df, items, subjects="Subject ID", n_bins=5):
+    '''Exact agreement of binned ratings, mean absolute difference of ratings,
+    weighted kappa of binned ratings and Krippendorff's alpha of ratings for all items'''
+    values = df[items].to_numpy(dtype=float)
+    subject_codes, position = subject_positions(df[subjects])
+    x = tensor_from_codes(subject_codes, position, values)
+    binned = tensor_from_codes(subject_codes, position, bin_items(values, n_bins))
+
+    return pd.DataFrame({
+        "Item": items,
+        "Agreement Percentage": exact_agreement(binned),
+        "Mean difference (Score 0 to 1)": mean_abs_delta(x),
+        "Weighted Kappa": weighted_kappa(binned),
+        "Krippendorff Alpha": krippendorff_alpha(x)
+    })
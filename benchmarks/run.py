@@ -0,0 +1,173 @@
+import pandas as pd
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic_data import REPO_DIR, generate
+from data_preprocessing import (
+    merge_sources, preprocess_diagnostics_file, preprocess_facets, preprocess_sdq_file, split_by_anchor)
+from facets_preprocessing import INDEX_COLUMNS
+from paper_analysis.mult_reg import run_ols
+from paper_analysis.reliability import add_rater_count_col, check_irr_icc, filter_doubly_rated
+
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+SDQ_SUBSCALES = ["emotion", "conduct", "hyper", "peer", "prosoc", "tot"]
+
+# Subjects, raters, FACETS items and share of doubly rated subjects
+SCALES = {
+    "small": {"n_subjects": 200, "n_raters": 20, "n_items": 59, "overlap": 0.5},
+    "medium": {"n_subjects": 2000, "n_raters": 100, "n_items": 59, "overlap": 0.5},
+    "large": {"n_subjects": 20000, "n_raters": 400, "n_items": 59, "overlap": 0.5},
+}
+
+def make_stages():
+    '''Stages in pipeline order, every stage takes and returns a dict of data.
+    A stage only reads what earlier stages produced.'''
+    def facets_transform(data):
+        data["facets"] = preprocess_facets("data/facets.json", chunk_size=1000)
+        return data
+
+    def sdq_score(data):
+        data["sdq"] = preprocess_sdq_file().rename(columns={"anonymised ID": "Study ID"})
+        data["diagnostics"] = preprocess_diagnostics_file()
+        return data
+
+    def merge(data):
+        data["merged"] = merge_sources(data["sdq"], data["facets"], data["diagnostics"])
+        return data
+
+    def split(data):
+        data["split"] = split_by_anchor(data["merged"])
+        return data
+
+    def ols(data):
+        facets_cols = [col for col in data["split"].columns if "_" in col]
+        run_ols(data["split"], facets_cols, SDQ_SUBSCALES)
+        return data
+
+    def icc(data):
+        facets = data["facets"]
+        facets_cols = [col for col in facets.columns if col not in INDEX_COLUMNS]
+        # ICC across clinics, like the reliability analysis
+        facets = add_rater_count_col(filter_doubly_rated(facets))
+        check_irr_icc(facets, facets_cols, "N Rater", "ICC1")
+        return data
+
+    return {
+        "FACETSFormatter.transform": facets_transform,
+        "preprocess_sdq (SDQScorer.score)": sdq_score,
+        "merge_sources": merge,
+        "split_by_anchor": split,
+        "run_ols": ols,
+        "check_irr_icc": icc,
+    }
+
+def run_stages(repeat=3):
+    '''Times every stage repeat times (best time is kept), then runs all stages once more
+    under tracemalloc for peak memory. Stage output is discarded.'''
+    stages = make_stages()
+    results = {name: {"seconds": [], "peak_mb": None} for name in stages}
+
+    for i in range(repeat + 1):
+        measure_memory = i == repeat
+        data = {}
+        for name, stage in stages.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                if measure_memory:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                data = stage(data)
+                seconds = time.perf_counter() - start
+                if measure_memory:
+                    results[name]["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                    tracemalloc.stop()
+            if not measure_memory:
+                results[name]["seconds"].append(seconds)
+
+    return {
+        name: {"seconds": min(result["seconds"]), "peak_mb": result["peak_mb"]}
+        for name, result in results.items()
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+def run_benchmarks(scales, repeat=3, seed=0):
+    '''Generates the synthetic exports of every scale in a temporary directory and runs the stages there'''
+    results = {"environment": environment(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "scales": {}}
+    cwd = os.getcwd()
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            n_entries = generate(tmp, seed=seed, **SCALES[scale])
+            os.chdir(tmp)
+            try:
+                stages = run_stages(repeat=repeat)
+            finally:
+                os.chdir(cwd)
+        results["scales"][scale] = {"parameters": SCALES[scale], "n_entries": n_entries, "stages": stages}
+        for name, stage in stages.items():
+            print(f"{scale:>7} {name:<34} {stage['seconds']:9.3f}s {stage['peak_mb']:9.1f} MB")
+    return results
+
+def compare(results, baseline, threshold=1.2):
+    '''Stages slower or using more memory than threshold x the baseline, as printed lines'''
+    regressions = []
+    for scale, scale_results in results["scales"].items():
+        baseline_stages = baseline.get("scales", {}).get(scale, {}).get("stages", {})
+        for name, stage in scale_results["stages"].items():
+            if name not in baseline_stages:
+                continue
+            for metric, unit in [("seconds", "s"), ("peak_mb", " MB")]:
+                before, after = baseline_stages[name][metric], stage[metric]
+                ratio = after / before if before else float("inf")
+                print(f"{scale:>7} {name:<34} {metric:<8} {before:9.3f}{unit} -> {after:9.3f}{unit} ({ratio:.2f}x)")
+                if ratio > threshold:
+                    regressions.append(f"{scale} {name} {metric} {ratio:.2f}x")
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Times and memory-profiles the pipeline stages on synthetic data")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["small"])
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage, the best is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIR, "latest.json"))
+    parser.add_argument("--baseline", help="Results JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, repeat=args.repeat, seed=args.seed)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), threshold=args.threshold)
+        if regressions:
+            print("Regressions:")
+            print("\n".join(regressions))
+            raise SystemExit(1)
@@ -0,0 +1,100 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+
+from facets_preprocessing import ENTRIES_KEY, FACETS_GROUP_ID
+from sdq_scoring import ITEMS as SDQ_ITEMS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRANSLATION_FILE = "facets_item_translation.csv"
+DIAGNOSES = ["ADHD", "Anxiety", "Autism", "Coordination", "Learning"]
+
+def facets_item_ids(n_items):
+    '''Item UUIDs of the translation file, extra items get generated UUIDs (they keep their ID as name)'''
+    translation = pd.read_csv(os.path.join(REPO_DIR, TRANSLATION_FILE))
+    ids = list(translation.loc[translation["locale_code"] == "en", "assessment_item_id"])[:n_items]
+    return ids + [f"00000000-0000-4000-8000-{i:012d}" for i in range(n_items - len(ids))]
+
+def generate(out_dir, n_subjects=200, n_raters=20, n_items=59, overlap=0.5, missing=0.05, seed=0):
+    '''Writes data/facets.json, data/sdq.csv, data/diagnostics.csv and data/id_mapping_facets.csv
+    with the schemas of the real exports, and a copy of the item translation file, to out_dir.
+    Raters work in clinics of two, every subject belongs to one clinic and is rated by
+    both raters with probability overlap (the doubly rated subjects used for reliability).
+    Ratings are a subject level plus rater noise, SDQ scores depend on the subject level.
+    Returns the number of FACETS entries.'''
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, TRANSLATION_FILE), os.path.join(out_dir, TRANSLATION_FILE))
+
+    subjects = [f"{i:08x}-0000-4000-8000-{seed:012d}" for i in range(n_subjects)]
+    study_ids = [f"S{i:06d}" for i in range(n_subjects)]
+    raters = [f"{rng.integers(1 << 60):016x}" for _ in range(n_raters)]
+    items = facets_item_ids(n_items)
+
+    n_clinics = max(n_raters // 2, 1)
+    clinic = rng.integers(0, n_clinics, n_subjects)
+    level = rng.random((n_subjects, 1))
+    item_level = np.clip(level + rng.normal(0, 0.15, (n_subjects, n_items)), 0, 1)
+
+    entries = []
+    for s, subject in enumerate(subjects):
+        clinic_raters = raters[2*clinic[s]:2*clinic[s]+2] or raters[:1]
+        n_ratings = len(clinic_raters) if rng.random() < overlap else 1
+        for r, rater in enumerate(clinic_raters[:n_ratings]):
+            values = np.clip(item_level[s] + rng.normal(0, 0.1, n_items), 0, 1).round(3)
+            answered = rng.random(n_items) >= missing
+            entries.append({
+                "subject_id": subject,
+                "last_updated_at": f"2024-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}T10:{r:02d}:00Z",
+                "lisapedia_respondent_actor_id": "teacher",
+                # A few entries of other groups, they are filtered out
+                "subject_group_id": FACETS_GROUP_ID if rng.random() > 0.05 else "other-group",
+                "respondent_hash": rater,
+                "assessment_response_sections": [{
+                    "lisapedia_section_id": "section",
+                    "assessment_response_items": [
+                        {"lisapedia_item_id": item, "value": float(value) if answered[i] else None}
+                        for i, (item, value) in enumerate(zip(items, values))
+                    ]
+                }]
+            })
+    with open(os.path.join(data_dir, "facets.json"), "w") as f:
+        json.dump({ENTRIES_KEY: entries}, f)
+
+    pd.DataFrame({"subject_id": subjects, "dislay_label": study_ids}).to_csv(
+        os.path.join(data_dir, "id_mapping_facets.csv"), index=False)
+
+    # SDQ responses 0-2, higher difficulties for lower FACETS levels, with the export's missing codes
+    sdq = np.clip(np.round(2*(1 - level) + rng.normal(0, 0.7, (n_subjects, len(SDQ_ITEMS)))), 0, 2).astype(int).astype(str)
+    sdq[rng.random(sdq.shape) < missing/2] = "#VALUE!"
+    sdq[rng.random(sdq.shape) < missing/2] = "-1"
+    sdq[rng.random(sdq.shape) < missing] = ""
+    sdq_df = pd.DataFrame(sdq, columns=SDQ_ITEMS)
+    sdq_df.insert(0, "anonymised ID", study_ids)
+    sdq_df.insert(1, "SDQ completion", rng.choice(["1", "1", "1", "0"], n_subjects))
+    sdq_df.to_csv(os.path.join(data_dir, "sdq.csv"), sep=";", index=False)
+
+    diagnostics = pd.DataFrame({"Study ID": study_ids, "Diag completion": rng.choice([1, 1, 0], n_subjects)})
+    for diagnosis in DIAGNOSES:
+        diagnostics[diagnosis] = rng.choice([" Y", "N ", "N", "N", "N/A", ""], n_subjects)
+    diagnostics.to_csv(os.path.join(data_dir, "diagnostics.csv"), sep=";", index=False)
+
+    return len(entries)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Writes synthetic FACETS, SDQ and diagnostics exports")
+    parser.add_argument("out_dir", help="Directory to write data/ and the item translation file to")
+    parser.add_argument("--subjects", type=int, default=200)
+    parser.add_argument("--raters", type=int, default=20)
+    parser.add_argument("--items", type=int, default=59)
+    parser.add_argument("--overlap", type=float, default=0.5, help="Share of subjects rated by two raters")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    n_entries = generate(args.out_dir, args.subjects, args.raters, args.items, args.overlap, seed=args.seed)
+    print(f"{n_entries} FACETS entries written to {args.out_dir}")
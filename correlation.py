@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+from scipy import stats
+
+def masked_corr(X, Y):
+    '''Pairwise complete correlations between the columns of X (n x p) and Y (n x q),
+    NaN marks missing values. All sums are computed with matrix products over
+    the observed-value masks, so every pair uses the rows where both are observed.
+    Leading batch dimensions are supported (e.g. resamples).
+    Returns the (p x q) correlations and pair counts.'''
+    mask_x = ~np.isnan(X)
+    mask_y = ~np.isnan(Y)
+
+    X = np.where(mask_x, X, 0)
+    Y = np.where(mask_y, Y, 0)
+    # Shift by column means first, correlations don't change but sums stay small
+    with np.errstate(invalid="ignore", divide="ignore"):
+        X = np.where(mask_x, X - X.sum(axis=-2, keepdims=True) / mask_x.sum(axis=-2, keepdims=True), 0)
+        Y = np.where(mask_y, Y - Y.sum(axis=-2, keepdims=True) / mask_y.sum(axis=-2, keepdims=True), 0)
+    mask_x = mask_x.astype(float)
+    mask_y = mask_y.astype(float)
+    Xt = np.swapaxes(X, -1, -2)
+    mask_xt = np.swapaxes(mask_x, -1, -2)
+
+    n = mask_xt @ mask_y
+    sum_x = Xt @ mask_y
+    sum_y = mask_xt @ Y
+    sum_xx = (Xt**2) @ mask_y
+    sum_yy = mask_xt @ (Y**2)
+    sum_xy = Xt @ Y
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = sum_xy - sum_x*sum_y/n
+        var_x = sum_xx - sum_x**2/n
+        var_y = sum_yy - sum_y**2/n
+        r = cov / np.sqrt(var_x*var_y)
+    return np.clip(r, -1, 1), n
+
+def corr_block(data, x_cols, y_cols, method="pearson", alpha=0.05):
+    '''Correlations of x_cols (e.g. FACETS items) with y_cols (e.g. SDQ subscales) only,
+    with pairwise deletion of missing values, t-test p-values and Fisher z confidence intervals.
+    For spearman, each column is ranked over its observed values once, this is
+    the same as ranking per pair when there are no missing values.
+    Returns a dict of (x_cols x y_cols) DataFrames: r, pval, ci_low, ci_high, n.'''
+    X = data[x_cols]
+    Y = data[y_cols]
+    if method == "spearman":
+        X = X.rank()
+        Y = Y.rank()
+    elif method != "pearson":
+        raise ValueError(f"Unknown correlation method {method}")
+
+    r, n = masked_corr(X.to_numpy(dtype=float), Y.to_numpy(dtype=float))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        df = n - 2
+        t = r * np.sqrt(df / (1 - r**2))
+        pval = 2 * stats.t.sf(np.abs(t), df)
+
+        z = np.arctanh(r)
+        z_crit = stats.norm.ppf(1 - alpha/2)
+        z_se = 1 / np.sqrt(n - 3)
+        ci_low = np.tanh(z - z_crit*z_se)
+        ci_high = np.tanh(z + z_crit*z_se)
+
+    frame = lambda values: pd.DataFrame(values, index=x_cols, columns=y_cols)
+    return {
+        "r": frame(r),
+        "pval": frame(pval),
+        "ci_low": frame(ci_low),
+        "ci_high": frame(ci_high),
+        "n": frame(n.astype(int))
+    }
+
+def tidy_corr(corr):
+    # One row per pair of columns
+    tidy = pd.concat({
+        "r": corr["r"].stack(),
+        "PVal": corr["pval"].stack(),
+        "CI low": corr["ci_low"].stack(),
+        "CI high": corr["ci_high"].stack(),
+        "N": corr["n"].stack()
+    }, axis=1)
+    tidy.index.names = ["Item", "Subscale"]
+    return tidy.reset_index()
@@ -1,91 +1,73 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-
-def make_corr_matrix(data_for_corr, sdq_subscales, facets_cols, file_name_prefix=""):
-    corr_mat = data_for_corr.corr().loc[facets_cols, sdq_subscales].sort_values("tot", ascending=False)
+import argparse
+import logging
+
+from intermediates import read_intermediate
+from regression import fit_ols
+from correlation import corr_block, tidy_corr
+from group_stats import group_comparison_table, significant_pairs
+from plotting import plot_boxplot_pairs, plot_histograms, plot_scatters, write_index
+from instrumentation import configure_logging, stage
+
+logger = logging.getLogger(__name__)
+
+@stage("correlation")
+def make_corr_matrix(data_for_corr, sdq_subscales, facets_cols, file_name_prefix="", method="pearson"):
+    # Only the FACETS x SDQ block is computed
+    corr = corr_block(data_for_corr, facets_cols, sdq_subscales, method=method)
+    corr_mat = corr["r"].sort_values("tot", ascending=False)
     corr_mat.to_csv(f"output/corr_mat{file_name_prefix}.csv", float_format='%.2f')
 
-def make_scatter_plots(data, sdq_subscales, facets_cols, file_name_prefix=""):
-    # Grouped scatter plots
-
-    fig, axs = plt.subplots(len(facets_cols), len(sdq_subscales), figsize=(30, 100))  # 3 subplots side by side
-    
-    for i, facets_col in enumerate(facets_cols):
-        for j, sdq_subscale in enumerate(sdq_subscales):
-            axs[i, j].scatter(data[facets_col], data[sdq_subscale])
-            axs[i, j].set_xlabel(facets_col)
-            axs[i, j].set_ylabel(sdq_subscale)
-    
-    fig.subplots_adjust(hspace=0.4, wspace=0.4)
-    axs = axs.flatten()
-
-    # Set ylim
-    for ax in axs:
-        ax.set_xlim([0, 1.0])
-
-    plt.tight_layout()
+    # p-values and confidence intervals, one row per item and subscale
+    tidy_corr(corr).to_csv(f"output/corr_stats{file_name_prefix}.csv", index=False, float_format='%.4f')
 
-    #plt.tight_layout()
-    plt.savefig(f"plots/scatter{file_name_prefix}.png")
+@stage("scatter_plots")
+def make_scatter_plots(data, sdq_subscales, facets_cols, file_name_prefix="", n_workers=1):
+    # Scatter plots, one figure per FACETS item with a panel per subscale
+    out_dir = f"plots/scatter{file_name_prefix}/"
+    paths = plot_scatters(data, facets_cols, sdq_subscales, out_dir, n_workers=n_workers)
+    write_index(out_dir, {"FACETS items x SDQ subscales": paths}, title="Scatter plots")
 
-def plot_histograms_facets(data, facets_cols, file_name_prefix=""):
+@stage("histograms")
+def plot_histograms_facets(data, facets_cols, file_name_prefix="", n_workers=1):
     # Distribution of each FACETS item
-    fig, axs = plt.subplots(len(facets_cols), 1, figsize=(6, 150))  # 3 subplots side by side
-    
-    for i, facets_col in enumerate(facets_cols):
-        counts, bins, _ = axs[i].hist(data[facets_col])
-        axs[i].set_xlabel(facets_col)
-
-        axs[i].set_xlim([0, 1])
-
-        # Calculate mean and standard deviation
-        mean = np.mean(data[facets_col])
-        median = np.median(data[facets_col])
-        std_dev = np.std(data[facets_col])
-
-        # Plot lines for 1 and 2 standard deviations
-        axs[i].axvline(mean, color='b', linestyle='--', label='Mean')
-        axs[i].axvline(median, color='b', linestyle='-', label='Median')
-        axs[i].axvline(mean - std_dev, color='y', linestyle='--', label='-1 SD')
-        axs[i].axvline(mean + std_dev, color='y', linestyle='--', label='+1 SD')
-        axs[i].axvline(mean - 2*std_dev, color='y', linestyle='--', label='-2 SD')
-        axs[i].axvline(mean + 2*std_dev, color='y', linestyle='--', label='+2 SD')
-
-
-    fig.subplots_adjust(hspace=0.4, wspace=0.4)
-    axs = axs.flatten()
-
-    handles, labels = axs[0].get_legend_handles_labels()
-    fig.legend(handles, labels, loc='upper right')
-
-    plt.tight_layout()
-
-    #plt.tight_layout()
-    plt.savefig(f"plots/facet_histograms{file_name_prefix}.png")
+    out_dir = f"plots/facet_histograms{file_name_prefix}/"
+    paths = plot_histograms(data, facets_cols, out_dir, n_workers=n_workers)
+    write_index(out_dir, {"FACETS items": paths}, title="FACETS histograms")
 
+@stage("ols")
 def multiple_regression(data, sdq_subscales, facets_cols, file_name_prefix=""):
-    import statsmodels.api as sm
-    for subscale in sdq_subscales:
-        print(subscale)
-        mod = sm.OLS(data[subscale], data[facets_cols])
-        result = mod.fit()
-
-        with open(f"output/ols_{subscale}{file_name_prefix}.csv", 'w') as f:
-            f.write(result.summary().as_csv())
-
-def group_comparisons(data, facets_cols):
-    for diag in [x for x in data.columns if "Diag." in x]:
-        print(diag)
-        for facets_col in facets_cols:
-            print(facets_col)
-            data[[diag, facets_col]].boxplot(by=diag)
-            plt.ylim([0, 1])
-            plt.savefig(f"plots/diags/{diag}_{facets_col}.png")
+    coefs, fit = fit_ols(data, facets_cols, sdq_subscales)
+    logger.info("%s", fit)
+
+    for subscale, subscale_coefs in coefs.groupby("Subscale", sort=False):
+        subscale_coefs.drop("Subscale", axis=1).to_csv(
+            f"output/ols_{subscale}{file_name_prefix}.csv", index=False)
+    fit.to_csv(f"output/ols_fit{file_name_prefix}.csv", index=False)
+
+@stage("group_comparisons")
+def group_comparisons(data, facets_cols, n_workers=1, alpha=0.05):
+    # Every FACETS item by every diagnosis in one table, boxplots only for significant pairs
+    diags = [x for x in data.columns if "Diag." in x]
+    table = group_comparison_table(data, facets_cols, diags, alpha=alpha)
+    table.to_csv("output/group_comparisons.csv", index=False, float_format='%.4f')
+
+    pairs = significant_pairs(table, alpha=alpha)
+    out_dir = "plots/diags/"
+    paths = plot_boxplot_pairs(data, pairs, out_dir, n_workers=n_workers)
+    write_index(out_dir, {
+        diag: [path for path, (pair_diag, _) in zip(paths, pairs) if pair_diag == diag] for diag in diags
+    }, title=f"FACETS items by diagnosis (FDR < {alpha})")
 
 if __name__ == "__main__":
 
-    data = pd.read_csv("data/merged.csv", index_col=0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes rendering plots")
+    args = parser.parse_args()
+    configure_logging()
+
+    data = read_intermediate("merged")
 
     description = data.describe()
     description.to_csv("output/description.csv")
@@ -101,12 +83,12 @@ if __name__ == "__main__":
     sdq_item_cols = [x for x in data.columns if x not in facets_cols and x not in sdq_subscales]
     
     #make_corr_matrix(data, sdq_subscales, facets_cols)
-    ##make_scatter_plots(data, sdq_subscales, facets_cols)
-    ##plot_histograms_facets(data, facets_cols)
+    ##make_scatter_plots(data, sdq_subscales, facets_cols, n_workers=args.workers)
+    ##plot_histograms_facets(data, facets_cols, n_workers=args.workers)
     #multiple_regression(data, sdq_subscales, facets_cols)
-    group_comparisons(data, facets_cols)
+    group_comparisons(data, facets_cols, n_workers=args.workers)
 
-    data_split_by_anchors = pd.read_csv("data/merged_split_by_anchor.csv")
+    data_split_by_anchors = read_intermediate("merged_split_by_anchor")
     data_split_by_anchors = data_split_by_anchors.drop("Study ID", axis=1)
     facets_cols_split = [x for x in data_split_by_anchors.columns if "LEFT" in x or "RIGHT" in x]
     #make_corr_matrix(data_split_by_anchors, sdq_subscales, facets_cols_split, file_name_prefix="_split")
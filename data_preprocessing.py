@@ -1,43 +1,98 @@
 import pandas as pd 
 import numpy as np
+import argparse
+import glob
 import json
+import logging
 
-from sdq_scoring import SDQScorer
-from facets_preprocessing import FACETSFormatter
+from sdq_scoring import SCORES, SDQScorer
+from facets_preprocessing import FACETSFormatter, INDEX_COLUMNS, transform_exports
+from lookup_tables import ITEM_TRANSLATION_PATH, LookupTables
+from preprocessing_cache import RowStore, hash_rows, replace_rows
+from intermediates import FORMATS, write_intermediate
+from aggregation import SortedGroups, factorize_keys, take_first
+from instrumentation import configure_logging, stage
+
+logger = logging.getLogger(__name__)
+
+FACETS_PATH = "data/facets.json"
+SDQ_PATH = "data/sdq.csv"
+DIAGNOSTICS_PATH = "data/diagnostics.csv"
+# Rows of the SDQ and diagnostics exports read at a time
+CSV_CHUNK_SIZE = 10000
+
+SDQ_ID = "anonymised ID"
+SDQ_NA_VALUES = ["#VALUE!", "-1"]
+SDQ_SCORE_COLUMNS = SCORES + ["impact"]
+DIAGNOSIS_VALUES = {"Y": 1, "N": 0, "N/A": np.nan}
+DIAGNOSTICS_COMPLETION_NA_VALUES = ["", "N/A", "NA", "#N/A", "NaN", "nan"]
+
+# FACETS columns that are not averaged per participant
+FACETS_METADATA_COLUMNS = ["Entry ID", "Actor type", "Group ID", "Time", "Respondent Hash", "Subject ID"]
     
-def preprocess_facets(facets_data):
-    formatter = FACETSFormatter(facets_data)
-    df = formatter.transform()
-    print(df)
+def facets_paths(pattern):
+    # FACETS exports matching a path or glob pattern, in name order (delivery order for dated names)
+    paths = sorted(glob.glob(pattern))
+    if len(paths) == 0:
+        raise FileNotFoundError(f"No FACETS export matches {pattern}")
+    return paths
+
+def preprocess_facets(facets_data, chunk_size=None, locale="en", n_workers=1):
+    if isinstance(facets_data, list):
+        # Paths of several exports, transformed in parallel and deduplicated
+        df, _ = transform_exports(facets_data, chunk_size=chunk_size or 1000, locale=locale, n_workers=n_workers)
+    elif chunk_size is None:
+        df = FACETSFormatter(facets_data, locale=locale).transform()
+    else:
+        # facets_data is the path to the json file, entries are streamed in chunks
+        df = FACETSFormatter.from_file(facets_data, chunk_size=chunk_size, locale=locale).transform()
+    logger.debug("Transformed FACETS data:\n%s", df)
 
     # Filter by subject group ed5e3cf6-67f0-405c-be85-f33d3184ec3a
     df = df[df["Group ID"] == "ed5e3cf6-67f0-405c-be85-f33d3184ec3a"]
 
     return df
 
-def preprocess_sdq(sdq_data):
+@stage("preprocess_sdq")
+def preprocess_sdq(sdq_data, drop_empty_columns=True):
 
     # Remove empty rows and columns
-    sdq_data = sdq_data.dropna(axis=1, how="all")
+    if drop_empty_columns:
+        sdq_data = sdq_data.dropna(axis=1, how="all")
     sdq_data = sdq_data.dropna(axis=0, how="all")
-    # Replace #VALUE! and -1 with np.nan
-    sdq_data.replace("#VALUE!", np.nan, inplace=True)
-    sdq_data.replace("-1", np.nan, inplace=True)
-    # Drop where SDQ completion != 1
-    sdq_data = sdq_data[sdq_data["SDQ completion"] == 1]
 
-    # Make all columns numeric except ID
-    for col in sdq_data.columns:
-        if col != "anonymised ID":
-            sdq_data[col] = pd.to_numeric(sdq_data[col])
+    # Make all columns numeric except ID, #VALUE! and -1 are NaN. Columns read
+    # with dtypes (read_sdq) are numeric already, only text columns are converted.
+    value_cols = [col for col in sdq_data.columns if col != SDQ_ID]
+    text_cols = [col for col in value_cols if not pd.api.types.is_numeric_dtype(sdq_data[col])]
+    if len(text_cols) > 0:
+        converted = sdq_data[text_cols].replace(SDQ_NA_VALUES, np.nan).apply(pd.to_numeric)
+        sdq_data = pd.concat([sdq_data.drop(text_cols, axis=1), converted], axis=1)[sdq_data.columns]
+    sdq_data = sdq_data.copy()
+    sdq_data[value_cols] = sdq_data[value_cols].where(sdq_data[value_cols] != -1)
+
+    # Drop where SDQ completion != 1
+    sdq_data = sdq_data[sdq_data["SDQ completion"] == 1].astype({"SDQ completion": int})
 
     # Score
     sdq_scorer = SDQScorer(sdq_data)
     scored_sdq = sdq_scorer.score()
-    print(scored_sdq)
+    logger.debug("Scored SDQ:\n%s", scored_sdq)
 
     return scored_sdq
 
+def _recode_diagnosis(col):
+    # Y as 1, N and empty as 0, N/A as NaN, whitespace is stripped. Only the distinct
+    # answers (categories) are recoded, rows take them by category code.
+    if pd.api.types.is_numeric_dtype(col):
+        return col.fillna(0)
+    col = col.astype("category")
+    answers = [str(answer).strip() for answer in col.cat.categories]
+    # Code -1 (empty) takes the 0 appended last
+    recoded = np.array([DIAGNOSIS_VALUES.get(answer, answer) for answer in answers] + [0], dtype=object)
+    return pd.Series(recoded[col.cat.codes.to_numpy()], index=col.index, name=col.name)
+
+@stage("preprocess_diagnostics")
 def preprocess_diagnostics(data):
     # Drop rows with empty Study ID 
     data = data[~(data["Study ID"].isna())]
@@ -46,86 +101,281 @@ def preprocess_diagnostics(data):
     data = data[data["Diag completion"] == 1]
     data = data.drop("Diag completion", axis=1)
 
-    # Strip whitespaces
-    data = data.apply(lambda col: col.str.strip())
-
-    # Replace NaN with 0
-    data = data.fillna(0)
-
-    # Replace Y with 1, N with 0, N/A with nan
-    data = data.replace({"Y": 1, "N": 0, "N/A": np.nan})
+    # Strip whitespaces, replace empty with 0, Y with 1, N with 0, N/A with nan
+    data = pd.DataFrame({
+        col: data[col] if col == "Study ID" else _recode_diagnosis(data[col]) for col in data.columns
+    }, index=data.index).infer_objects()
 
     # Add prefix to diag columns, ignore Study ID column
     data.columns = ["Diag."+x if x != "Study ID" else x for x in data.columns]
 
-    print(data.columns)
-    print(data.dtypes)
+    logger.debug("Diagnostics columns and types:\n%s", data.dtypes)
 
     return data
 
+def read_sdq(path=SDQ_PATH, chunk_size=CSV_CHUNK_SIZE):
+    '''Chunks of chunk_size rows of the SDQ export, all columns except ID are read as numbers
+    and #VALUE! and -1 as NaN, so chunks need no conversion'''
+    header = pd.read_csv(path, sep=";", nrows=0).columns
+    dtype = {col: str if col == SDQ_ID else float for col in header}
+    return pd.read_csv(path, sep=";", dtype=dtype, na_values=SDQ_NA_VALUES, chunksize=chunk_size)
+
+def read_diagnostics(path=DIAGNOSTICS_PATH, chunk_size=CSV_CHUNK_SIZE):
+    '''Chunks of chunk_size rows of the diagnostics export, diagnoses are read as
+    categories, so every distinct answer is stored and recoded once'''
+    header = pd.read_csv(path, sep=";", nrows=0).columns
+    dtype = {col: "category" for col in header}
+    dtype.update({"Study ID": str, "Diag completion": float})
+    # Only empty cells are missing (no diagnosis, recoded to 0), N/A is an answer of its own (recoded to NaN)
+    na_values = {col: [""] for col in header}
+    na_values["Diag completion"] = DIAGNOSTICS_COMPLETION_NA_VALUES
+    return pd.read_csv(
+        path, sep=";", dtype=dtype, keep_default_na=False, na_values=na_values, chunksize=chunk_size)
+
+def empty_sdq_columns(has_values):
+    # Columns that are empty in the whole export, except score columns the scorer wrote
+    return [col for col in has_values.index[~has_values] if col not in SDQ_SCORE_COLUMNS]
+
+@stage("preprocess_sdq_file")
+def preprocess_sdq_file(path=SDQ_PATH, chunk_size=CSV_CHUNK_SIZE):
+    '''preprocess_sdq of the SDQ export, read, cleaned and scored chunk by chunk,
+    so only one chunk of raw rows is in memory'''
+    scored = []
+    has_values = None
+    for chunk in read_sdq(path, chunk_size):
+        chunk_has_values = chunk.notna().any()
+        has_values = chunk_has_values if has_values is None else has_values | chunk_has_values
+        scored.append(preprocess_sdq(chunk, drop_empty_columns=False))
+    sdq_data = pd.concat(scored)
+    return sdq_data.drop(empty_sdq_columns(has_values), axis=1)
+
+@stage("preprocess_diagnostics_file")
+def preprocess_diagnostics_file(path=DIAGNOSTICS_PATH, chunk_size=CSV_CHUNK_SIZE):
+    # preprocess_diagnostics of the diagnostics export, chunk by chunk
+    return pd.concat([preprocess_diagnostics(chunk) for chunk in read_diagnostics(path, chunk_size)])
+
+@stage("split_by_anchor")
 def split_by_anchor(data):
+    '''Every FACETS column (scores 0 to 1) as two columns, distance below (_LEFT) and
+    above (_RIGHT) the middle anchor 0.5. All pairs are computed from one array and
+    added at once, data is not changed.'''
     facets_cols = [x for x in data.columns if "_" in x] + ["toileting"]
 
     # Move data to -0.5 so perfect behavior is 0
-    data[facets_cols] = data[facets_cols]-0.5
+    values = data[facets_cols].to_numpy(dtype=float) - 0.5
+    with np.errstate(invalid="ignore"):
+        left = np.where(values <= 0, -values, 0)
+        right = np.where(values >= 0, values, 0)
 
-    for col in facets_cols:
-        left_col_name = col+"_LEFT"
-        right_col_name = col+"_RIGHT"
+    # Interleaved as col_LEFT, col_RIGHT for every col
+    split = pd.DataFrame(
+        np.stack([left, right], axis=2).reshape(len(data), 2*len(facets_cols)),
+        columns=[col+side for col in facets_cols for side in ["_LEFT", "_RIGHT"]],
+        index=data.index)
 
-        data[left_col_name] = np.where(data[col]<=0, -data[col], 0)
-        data[right_col_name] = np.where((data[col]>=0), data[col], 0)
+    return pd.concat([data.drop(facets_cols, axis=1), split], axis=1)
 
-    data = data.drop(facets_cols, axis=1)
+@stage("merge")
+def merge_sources(sdq_data, facets_data, diagnostics_data):
+    # Study IDs are coded once for all sources, each source is reduced per code and joined by code
+    (sdq_codes, facets_codes, diagnostics_codes), study_ids = factorize_keys(
+        sdq_data["Study ID"], facets_data["Study ID"], diagnostics_data["Study ID"])
 
-    return data
+    sdq_cols = [col for col in sdq_data.columns if col != "Study ID"]
+    facets_cols = [col for col in facets_data.columns if col not in FACETS_METADATA_COLUMNS + ["Study ID"]]
+    diagnostics_cols = [col for col in diagnostics_data.columns if col != "Study ID"]
+    if len(set(sdq_cols) | set(facets_cols) | set(diagnostics_cols)) < len(sdq_cols + facets_cols + diagnostics_cols):
+        raise ValueError("SDQ, FACETS and diagnostics data have columns with the same name")
 
-if __name__ == "__main__":
-    
-    facets_data = json.load(open("data/facets.json"))
-    sdq_data = pd.read_csv("data/sdq.csv", sep=";")
-    diagnostics_data = pd.read_csv("data/diagnostics.csv", sep=";")
+    sdq_groups = SortedGroups(sdq_codes)
+    facets_groups = SortedGroups(facets_codes)
+    diagnostics_groups = SortedGroups(diagnostics_codes)
 
-    sdq_data = preprocess_sdq(sdq_data)
-    facets_data = preprocess_facets(facets_data)
-    diagnostics_data = preprocess_diagnostics(diagnostics_data)
-
-    sdq_data = sdq_data.rename(columns={"anonymised ID": "Study ID"})
-    
-    print("DEBUG 111")
-    sdq_data.to_csv("data/sdq_scored_cleaned.csv")
-    facets_data.to_csv("data/facets_transformed.csv")
-    diagnostics_data.to_csv("data/diagnostics_transformed.csv")
-
-    sdq_grouped = sdq_data.groupby("Study ID", as_index=False).mean()
-    facets_grouped = facets_data.drop([
-        "Entry ID",
-        "Actor type",
-        "Group ID",
-        "Time",
-        "Respondent Hash",
-        "Subject ID"], axis=1).groupby("Study ID", as_index=False).mean()
+    sdq_grouped = sdq_groups.mean(sdq_data[sdq_cols])
+    facets_grouped = facets_groups.mean(facets_data[facets_cols])
     # Take first entry for each participant (:TODO confirm that we do this)
-    diagnostics_grouped = diagnostics_data.groupby("Study ID").first()
+    diagnostics_grouped = take_first(diagnostics_data[diagnostics_cols], diagnostics_groups)
 
-    merged = sdq_grouped.merge(
-        facets_grouped, 
-        on="Study ID",
-        how="inner")
-    merged = merged.merge(
-        diagnostics_grouped,
-        on="Study ID",
-        how="inner"
-    )
-    print(merged.describe())
+    # Inner join on codes, codes follow the sorted Study IDs like groupby
+    codes, in_sdq, in_facets = np.intersect1d(
+        sdq_groups.codes, facets_groups.codes, assume_unique=True, return_indices=True)
+    codes, in_both, in_diagnostics = np.intersect1d(
+        codes, diagnostics_groups.codes, assume_unique=True, return_indices=True)
+    in_sdq, in_facets = in_sdq[in_both], in_facets[in_both]
 
-    merged.to_csv("data/merged.csv")
+    merged = pd.concat([
+        pd.DataFrame({"Study ID": study_ids[codes]}),
+        pd.DataFrame(
+            np.column_stack([sdq_grouped[in_sdq], facets_grouped[in_facets]]), 
+            columns=sdq_cols + facets_cols),
+        diagnostics_grouped.iloc[in_diagnostics].reset_index(drop=True)
+    ], axis=1)
 
-    print("Unique Patient IDs in SDQ: ", len(sdq_grouped["Study ID"].unique()))
-    print("Unique Patient IDs in FACETS: ", len(facets_grouped["Study ID"].unique()))
-    print("Unique Patient IDs in Merged: ", len(merged["Study ID"].unique()))
+    logger.info("Unique Patient IDs in SDQ: %d", len(sdq_groups.codes))
+    logger.info("Unique Patient IDs in FACETS: %d", len(facets_groups.codes))
+    logger.info("Unique Patient IDs in Merged: %d", len(merged))
+
+    return merged
+
+def write_merged(merged, format="csv"):
+    # describe() is only computed when it is logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Merged data:\n%s", merged.describe())
+    write_intermediate(merged, "merged", format)
 
     merged_grouped_and_split_by_anchor = split_by_anchor(merged)
-    merged_grouped_and_split_by_anchor.to_csv("data/merged_split_by_anchor.csv")
+    write_intermediate(merged_grouped_and_split_by_anchor, "merged_split_by_anchor", format)
+
+def write_sources(sdq_data, facets_data, diagnostics_data, format="csv"):
+    write_intermediate(sdq_data, "sdq_scored_cleaned", format)
+    write_intermediate(facets_data, "facets_transformed", format)
+    write_intermediate(diagnostics_data, "diagnostics_transformed", format)
 
+def run(format="csv", locale="en", facets=FACETS_PATH, n_workers=1):
+    paths = facets_paths(facets)
+    facets_data = paths if len(paths) > 1 else paths[0]
+    sdq_data = preprocess_sdq_file()
+    facets_data = preprocess_facets(facets_data, chunk_size=1000, locale=locale, n_workers=n_workers)
+    diagnostics_data = preprocess_diagnostics_file()
+
+    sdq_data = sdq_data.rename(columns={SDQ_ID: "Study ID"})
     
+    write_sources(sdq_data, facets_data, diagnostics_data, format)
+
+    merged = merge_sources(sdq_data, facets_data, diagnostics_data)
+    write_merged(merged, format)
+
+def update_store(store, chunks, preprocess):
+    '''Rows are keyed by the hash of their raw content, only unseen rows are preprocessed.
+    chunks of the source are read, hashed and preprocessed one at a time. Returns the
+    changed rows and whether every source column has a value in any row.'''
+    source_keys = []
+    new_rows = []
+    n_new = 0
+    has_values = None
+    for chunk in chunks:
+        chunk.index = hash_rows(chunk)
+        new_keys = store.new_keys(chunk.index, list(chunk.columns))
+        source_keys.append(chunk.index.to_numpy())
+        n_new += len(new_keys)
+        new_rows.append(preprocess(chunk[chunk.index.isin(new_keys)]))
+        chunk_has_values = chunk.notna().any()
+        has_values = chunk_has_values if has_values is None else has_values | chunk_has_values
+
+    new_rows = pd.concat(new_rows).rename_axis("Row Hash").reset_index()
+    logger.info("%d new or changed rows in %s", n_new, store.path)
+
+    return store.update(np.concatenate(source_keys), new_rows), has_values
+
+def remap_study_ids(facets_rows):
+    '''Maps the Subject IDs of cached FACETS rows to Study IDs again, so rows cached
+    before the ID mapping changed get their current Study ID. Returns the old and
+    new Study IDs of the rows whose Study ID changed.'''
+    study_ids = LookupTables.load().map_subjects(facets_rows["Subject ID"])
+    previous = facets_rows["Study ID"]
+    changed = (previous.astype(object).fillna("") != study_ids.astype(object).fillna("")).to_numpy()
+    remapped_ids = pd.concat([previous[changed], study_ids[changed]], ignore_index=True)
+    facets_rows["Study ID"] = study_ids
+    return remapped_ids
+
+def run_incremental(chunk_size=1000, format="csv", locale="en", facets=FACETS_PATH, n_workers=1):
+    # Item columns are named in locale by the item translation, cached entries of another
+    # locale or translation are transformed again. Study IDs are mapped again every run.
+    facets_store = RowStore("facets_entries", "Entry ID", params={
+        "locale": locale,
+        "item_translation": LookupTables.load().source_digest(ITEM_TRANSLATION_PATH)
+    }).load()
+    sdq_store = RowStore("sdq_rows", "Row Hash").load()
+    diagnostics_store = RowStore("diagnostics_rows", "Row Hash").load()
+
+    # FACETS entries already in the store are skipped while streaming the exports, in n_workers processes
+    new_facets, entry_ids = transform_exports(
+        facets_paths(facets), 
+        chunk_size=chunk_size, 
+        locale=locale, 
+        n_workers=n_workers,
+        exclude_entry_ids=facets_store.processed_keys)
+    logger.info("%d new or changed FACETS entries", len(new_facets))
+    changed_facets = facets_store.update(entry_ids, new_facets)
+    remapped_ids = remap_study_ids(facets_store.rows)
+
+    changed_sdq, sdq_has_values = update_store(
+        sdq_store, 
+        read_sdq(), 
+        lambda rows: preprocess_sdq(rows, drop_empty_columns=False).rename(
+            columns={SDQ_ID: "Study ID"}))
+    changed_diagnostics, _ = update_store(diagnostics_store, read_diagnostics(), preprocess_diagnostics)
+
+    facets_data = facets_store.rows
+    item_cols = sorted(x for x in facets_data.columns if x not in INDEX_COLUMNS)
+    facets_data = facets_data[INDEX_COLUMNS + item_cols]
+    sdq_data = sdq_store.rows.drop(["Row Hash"] + empty_sdq_columns(sdq_has_values), axis=1)
+    diagnostics_data = diagnostics_store.rows.drop("Row Hash", axis=1)
+
+    write_sources(sdq_data, facets_data, diagnostics_data, format)
+
+    # Only participants with new, changed or removed rows are merged again
+    changed_ids = set(pd.concat([
+        changed_facets["Study ID"], 
+        changed_sdq["Study ID"], 
+        changed_diagnostics["Study ID"],
+        remapped_ids
+    ]).dropna())
+    logger.info("%d participants to merge", len(changed_ids))
+
+    try:
+        stores = [facets_store, sdq_store, diagnostics_store]
+        if any(store.invalidated for store in stores):
+            raise ValueError("cached rows were transformed with other settings or columns")
+        merged_rows = merge_sources(
+            sdq_data[sdq_data["Study ID"].isin(changed_ids)],
+            facets_data[facets_data["Study ID"].isin(changed_ids)],
+            diagnostics_data[diagnostics_data["Study ID"].isin(changed_ids)])
+        replace_rows("merged", merged_rows, "Study ID", changed_ids, format)
+        replace_rows(
+            "merged_split_by_anchor", 
+            split_by_anchor(merged_rows), 
+            "Study ID", 
+            changed_ids,
+            format)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning("Can't update merged data in place, merging all participants: %s", e)
+        merged = merge_sources(sdq_data, facets_data, diagnostics_data)
+        write_merged(merged, format)
+
+    facets_store.save()
+    sdq_store.save()
+    diagnostics_store.save()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental", 
+        action="store_true",
+        help="Only process new or changed FACETS entries and SDQ/diagnostics rows, cached in data/cache/")
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="csv",
+        help="File format of the transformed and merged data, feather and parquet need pyarrow")
+    parser.add_argument(
+        "--locale",
+        default="en",
+        help="Locale of the FACETS item names (locale_code in facets_item_translation.csv), the analysis scripts expect en")
+    parser.add_argument(
+        "--facets",
+        default=FACETS_PATH,
+        help="FACETS export, or a glob pattern of several exports (e.g. 'data/exports/*.json') to combine")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes transforming FACETS exports at the same time")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.incremental:
+        run_incremental(format=args.format, locale=args.locale, facets=args.facets, n_workers=args.workers)
+    else:
+        run(format=args.format, locale=args.locale, facets=args.facets, n_workers=args.workers)
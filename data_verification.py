@@ -1,5 +1,9 @@
 import pandas as pd
 
+from intermediates import read_intermediate
+from rater_overlap import RaterSubjectIndex
+from instrumentation import configure_logging
+
 def print_stats(df):
     print(f"""{len(df)} FACETS entries,
           {len(df["Study ID"].unique())} participants, rated by
@@ -7,24 +11,16 @@ def print_stats(df):
     
 def how_many_rated_by_the_same_clinicians(df):
     # How many participants were rated by the same clinicans?
-    clinicians = list(df["Respondent Hash"].unique())
-    
-    # Get all sets of n_teachers_overlep teachers out of all teachers
-    import itertools
-    clinician_sets = list(itertools.combinations(clinicians, 2))
-    for clinician_set in clinician_sets:
-        sets_of_participants = []
-        for clinician in clinician_set:
-            participants_per_clinician = set(data[data["Respondent Hash"] == clinician]["Subject ID"].unique())
-            sets_of_participants.append(participants_per_clinician)
-        overlapping_participants = set.intersection(*sets_of_participants)
-        if len(overlapping_participants) > 0:
-            print(f"{len(overlapping_participants)} participants are rated by 2 clinicians: ", clinician_set)
+    index = RaterSubjectIndex(df, raters="Respondent Hash", subjects="Subject ID")
+    clinician_pairs = index.pairs(min_overlap=1)
+
+    for _, pair in clinician_pairs.iterrows():
+        clinician_set = (pair["Rater A Label"], pair["Rater B Label"])
+        print(f"{pair['N']} participants are rated by 2 clinicians: ", clinician_set)
 
 def check_for_irr(df):
     # Check that each participant was rated by two people
-    df = df[["Study ID", "Respondent Hash"]]
-    counts = df.groupby("Study ID").count()
+    counts = df[["Study ID", "Respondent Hash"]].groupby("Study ID").count()
     once = len(counts[counts["Respondent Hash"] == 1])
     twice = len(counts[counts["Respondent Hash"] == 2])
     more = len(counts[counts["Respondent Hash"] > 2])
@@ -37,7 +33,9 @@ def check_for_irr(df):
 
 if __name__ == "__main__":
 
-    data = pd.read_csv("data/facets_transformed.csv", index_col=0)
+    configure_logging()
+
+    data = read_intermediate("facets_transformed", columns=["Study ID", "Respondent Hash", "Subject ID"])
     
     print_stats(data)
     check_for_irr(data)
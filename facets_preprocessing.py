@@ -1,93 +1,280 @@
 import pandas as pd
 import numpy as np
+import itertools
 import json
+import logging
+import sys
+
+from instrumentation import stage
+from lookup_tables import LookupTables
+from parallel import SharedPool
+
+logger = logging.getLogger(__name__)
+
+# Only entries of this subject group are the latest version of FACETS
+FACETS_GROUP_ID = "ed5e3cf6-67f0-405c-be85-f33d3184ec3a"
+ENTRIES_KEY = "assessment_response_list_anonymized"
+
+ROW_COLUMNS = [
+    "Entry ID",
+    "Actor type",
+    "Subject ID",
+    "Group ID",
+    "Time",
+    "Respondent Hash",
+    "Section ID",
+    "Item ID",
+    "Value"
+]
+
+INDEX_COLUMNS = [
+    "Entry ID",
+    "Actor type",
+    "Subject ID",
+    "Study ID",
+    "Group ID",
+    "Time",
+    "Respondent Hash"
+]
+
+def iter_json_array(path, key=ENTRIES_KEY, buffer_size=1 << 20):
+    '''Yields the elements of the array stored under `key` in a JSON file
+    one at a time, without loading the whole file.
+    Only one element (plus the read buffer) is held in memory at a time.'''
+    decoder = json.JSONDecoder()
+    token = json.dumps(key)
+
+    with open(path, encoding="utf-8") as f:
+        # Find the key, keep the tail of the buffer in case it is split between reads
+        buffer = ""
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                raise KeyError(f"{key} not found in {path}")
+            buffer += chunk
+            start = buffer.find(token)
+            if start != -1:
+                buffer = buffer[start+len(token):]
+                break
+            buffer = buffer[-len(token):]
+
+        # Move to the opening bracket of the array
+        buffer = buffer.lstrip(": \n\r\t")
+        while not buffer:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                raise ValueError(f"Unexpected end of file in {path}")
+            buffer = chunk.lstrip(": \n\r\t")
+        if buffer[0] != "[":
+            raise ValueError(f"{key} in {path} is not an array")
+        pos = 1
+        eof = False
+
+        while True:
+            # Skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in " \n\r\t,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError("Buffer exhausted", buffer, pos)
+                element, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Element is split between reads, drop what was consumed and read more
+                buffer = buffer[pos:]
+                pos = 0
+                chunk = f.read(buffer_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield element
 
 class FACETSFormatter():
 
-    def __init__(self, json_data):
+    def __init__(self, json_data, chunk_size=None, columnar=True, exclude_entry_ids=None, locale="en", lookup_tables=None):
+        '''json_data is either the loaded FACETS json or an iterable of entries
+        (see from_file). If chunk_size is set, entries are transformed in chunks
+        of chunk_size entries, so only one chunk of item rows is in memory.
+        With columnar=True item values are written straight into a wide
+        (entries x items) array, otherwise a long frame is built and pivoted.
+        Entries with an Entry ID in exclude_entry_ids are skipped (already
+        transformed), the IDs of all entries in the export are kept in entry_ids.
+        Items are named by their slug in locale, IDs are looked up in lookup_tables
+        (by default the compiled tables cached in data/cache/, see lookup_tables.py).'''
         self.json = json_data
+        self.chunk_size = chunk_size
+        self.columnar = columnar
+        self.exclude_entry_ids = exclude_entry_ids if exclude_entry_ids is not None else set()
+        self.entry_ids = []
         self.df = None
+        self.locale = locale
+        self.lookup_tables = lookup_tables
         self.item_names = None
 
+    @classmethod
+    def from_file(cls, path, chunk_size=1000, **kwargs):
+        '''Incremental mode: entries are streamed from the json file one at a time'''
+        return cls(iter_json_array(path), chunk_size=chunk_size, **kwargs)
+
+    def _iter_entries(self):
+        entries = self.json[ENTRIES_KEY] if isinstance(self.json, dict) else self.json
+        self.entry_ids = []
+        for entry in entries:
+            # Have to filter by gruop id here to get latest version of FACETS
+            if entry["subject_group_id"] == FACETS_GROUP_ID:
+                entry_id = entry["subject_id"]+entry["last_updated_at"]
+                self.entry_ids.append(entry_id)
+                if entry_id not in self.exclude_entry_ids:
+                    yield entry
+
+    def _iter_row_chunks(self, entries, chunk_size):
+        # Rows are collected column by column, a chunk holds all items of chunk_size entries
+        columns = {name: [] for name in ROW_COLUMNS}
+        n_entries = 0
+        for entry in entries:
+            entry_id = entry["subject_id"]+entry["last_updated_at"]
+            for section in entry["assessment_response_sections"]:
+                section_id = section["lisapedia_section_id"]
+                for item in section["assessment_response_items"]:
+                    columns["Entry ID"].append(entry_id)
+                    columns["Actor type"].append(entry["lisapedia_respondent_actor_id"])
+                    columns["Subject ID"].append(entry["subject_id"])
+                    columns["Group ID"].append(entry["subject_group_id"])
+                    columns["Time"].append(entry["last_updated_at"])
+                    columns["Respondent Hash"].append(entry["respondent_hash"])
+                    columns["Section ID"].append(section_id)
+                    columns["Item ID"].append(item["lisapedia_item_id"])
+                    columns["Value"].append(item["value"])
+            n_entries += 1
+            if chunk_size is not None and n_entries == chunk_size:
+                yield pd.DataFrame(columns)
+                columns = {name: [] for name in ROW_COLUMNS}
+                n_entries = 0
+        if n_entries > 0 or chunk_size is None:
+            yield pd.DataFrame(columns)
+
     def _parse_entries(self):
         #print("Available fields: ", self.json["assessment_response_list_anonymized"][0].keys())
         #print("DEBUG", self.json["assessment_response_list_anonymized"][0])
 
+        with stage("parse") as s:
+            self.df = s.record(next(self._iter_row_chunks(self._iter_entries(), None)))
 
-        apple 1 size: 5, color: red 
-        [
-            [5, red],
-            [4, yellow]
-        ]
+    def _load_lookup_tables(self):
+        if self.lookup_tables is None:
+            self.lookup_tables = LookupTables.load()
+        return self.lookup_tables
 
-        assessment_response_list_anonymize: [
-            {student: 1, assessment_response_sections:[
-                
-            ]},
-            {student: 1, assessment_response_sections:[]}
-        ]
-
-        rows = []
-        for entry in self.json["assessment_response_list_anonymized"]:
-            # Have to filter by gruop id here to get latest version of FACETS
-            if entry["subject_group_id"] == "ed5e3cf6-67f0-405c-be85-f33d3184ec3a": 
-                for section in entry["assessment_response_sections"]:
-                    section_id = section["lisapedia_section_id"]
-                    for item in section["assessment_response_items"]:
-                        item_id = item["lisapedia_item_id"]
-                        value = item["value"]
-                        rows.append([
-                            entry["subject_id"]+entry["last_updated_at"],
-                            entry["lisapedia_respondent_actor_id"],
-                            entry["subject_id"],
-                            entry["subject_group_id"],
-                            entry["last_updated_at"],
-                            entry["respondent_hash"],
-                            section_id,
-                            item_id,
-                            value    
-                        ])
-                
-        facets_df = pd.DataFrame(rows, columns=[
-            "Entry ID",
-            "Actor type", 
-            "Subject ID", 
-            "Group ID", 
-            "Time", 
-            "Respondent Hash",
-            "Section ID",
-            "Item ID", 
-            "Value"
-        ])
-        
-        self.df = facets_df
+    def _load_item_names(self):
+        if self.item_names is None:
+            self.item_names = self._load_lookup_tables().item_names(self.locale)
+        return self.item_names
 
     def _replace_item_ids_with_values(self):
-        # item_translation = pd.read_csv("facets_item_translation.csv", 
-        #                                sep=",", 
-        #                                index_col="assessment_item_id")
-        item_translation = pd.read_csv("facets_item_translation.csv", 
-                                       sep=",")
-        item_translation_en = item_translation[item_translation["locale_code"] == "en"]
-        item_translation_en.set_index("assessment_item_id", inplace=True)
-        self.item_names = item_translation_en["slug"]
-
-        self.df["Item ID"] = self.df["Item ID"].map(
-            item_translation_en["slug"]).fillna(self.df["Item ID"])
-        
+        with stage("translate") as s:
+            self.df["Item ID"] = self._load_lookup_tables().translate_items(self.df["Item ID"], self.locale)
+            s.record(self.df)
+
     def _map_ids(self):
-        id_mapping = pd.read_csv("data/id_mapping_facets.csv", index_col="subject_id")
-        self.df["Study ID"] = self.df["Subject ID"].map(
-            id_mapping["dislay_label"]
-        )
+        with stage("map_ids") as s:
+            self.df["Study ID"] = self._load_lookup_tables().map_subjects(self.df["Subject ID"])
+            s.record(self.df)
+
+    def _build_columnar_chunk(self, entries, capacity, item_index, item_names):
+        '''Reads up to capacity entries into a preallocated (entries x items) array.
+        Entry level fields are stored once per entry, not once per item.
+        Item IDs missing from the translation get extra columns named by their ID.'''
+        meta = {name: [] for name in INDEX_COLUMNS if name != "Study ID"}
+        values = np.full((capacity, len(item_names)), np.nan)
+        seen = np.zeros(len(item_names), dtype=bool)
+        extra = {}
+
+        row = 0
+        n_read = 0
+        for entry in itertools.islice(entries, capacity):
+            n_read += 1
+            n_items = 0
+            for section in entry["assessment_response_sections"]:
+                for item in section["assessment_response_items"]:
+                    item_id = item["lisapedia_item_id"]
+                    value = item["value"]
+                    col = item_index.get(item_id)
+                    if col is None:
+                        if item_id not in extra:
+                            extra[item_id] = np.full(capacity, np.nan)
+                        extra[item_id][row] = np.nan if value is None else value
+                    else:
+                        values[row, col] = np.nan if value is None else value
+                        seen[col] = True
+                    n_items += 1
+            # Entries without items have no row in the long format either
+            if n_items == 0:
+                values[row] = np.nan
+                for item_values in extra.values():
+                    item_values[row] = np.nan
+                continue
+            meta["Entry ID"].append(entry["subject_id"]+entry["last_updated_at"])
+            meta["Actor type"].append(sys.intern(entry["lisapedia_respondent_actor_id"]))
+            meta["Subject ID"].append(entry["subject_id"])
+            meta["Group ID"].append(sys.intern(entry["subject_group_id"]))
+            meta["Time"].append(entry["last_updated_at"])
+            meta["Respondent Hash"].append(sys.intern(entry["respondent_hash"]))
+            row += 1
+
+        df = pd.DataFrame(meta)
+        self.df = df
+        self._map_ids()
+        df = df[INDEX_COLUMNS]
+
+        items = pd.DataFrame(values[:row, seen], columns=item_names[seen])
+        for item_id, item_values in extra.items():
+            items[item_id] = item_values[:row]
+        return pd.concat([df, items], axis=1), n_read
+
+    def _transform_columnar(self):
+        item_names = self._load_item_names().sort_values()
+        item_index = {item_id: i for i, item_id in enumerate(item_names.index)}
+        item_names = pd.Index(item_names.values)
+
+        entries = self._iter_entries()
+        if self.chunk_size is not None:
+            capacity = self.chunk_size
+        elif isinstance(self.json, dict):
+            capacity = len(self.json[ENTRIES_KEY])
+        else:
+            capacity = 1000
+
+        # Parsing, translating item IDs to columns and mapping IDs happen together per chunk
+        with stage("parse") as s:
+            chunks = []
+            while True:
+                chunk, n_read = self._build_columnar_chunk(entries, capacity, item_index, item_names)
+                if n_read == 0 and len(chunks) > 0:
+                    break
+                chunks.append(chunk)
+                if n_read < capacity:
+                    break
+            s.record(rows=sum(len(chunk) for chunk in chunks))
+
+        with stage("pivot") as s:
+            df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+            # Same column and row order as the pivoted long format
+            item_cols = sorted(x for x in df.columns if x not in INDEX_COLUMNS)
+            df = df[INDEX_COLUMNS + item_cols]
+            self.df = s.record(df.sort_values(INDEX_COLUMNS, ignore_index=True))
+        return self.df
 
     def _transpose_items(self):
-        df_to_transpose = self.df.drop("Section ID", axis=1)
-        df_to_transpose = df_to_transpose.reset_index().pivot(index = [
-            "Entry ID", "Actor type", "Subject ID","Study ID", "Group ID", "Time", "Respondent Hash"
-        ], columns = "Item ID", values = "Value").reset_index()
+        with stage("pivot") as s:
+            df_to_transpose = self.df.drop("Section ID", axis=1)
+            df_to_transpose = df_to_transpose.reset_index().pivot(index = [
+                "Entry ID", "Actor type", "Subject ID","Study ID", "Group ID", "Time", "Respondent Hash"
+            ], columns = "Item ID", values = "Value").reset_index()
 
-        self.df = df_to_transpose
+            self.df = s.record(df_to_transpose)
 
     def _get_cat_names(self):
         cats = []
@@ -98,12 +285,76 @@ class FACETSFormatter():
         cats = set(cat)
         return cats
 
+    def _transform_chunked(self):
+        # Each chunk holds complete entries, so it can be pivoted on its own
+        wide_chunks = []
+        chunks = self._iter_row_chunks(self._iter_entries(), self.chunk_size)
+        while True:
+            with stage("parse") as s:
+                self.df = s.record(next(chunks, None))
+            if self.df is None:
+                break
+            self._replace_item_ids_with_values()
+            self._map_ids()
+            self._transpose_items()
+            wide_chunks.append(self.df)
+
+        if len(wide_chunks) == 0:
+            # Empty export, or every entry excluded
+            self.df = pd.DataFrame(columns=INDEX_COLUMNS)
+            return self.df
+        df = pd.concat(wide_chunks, ignore_index=True)
+        item_cols = sorted(x for x in df.columns if x not in INDEX_COLUMNS)
+        # Same row order as the pivot of the whole export
+        self.df = df[INDEX_COLUMNS + item_cols].sort_values(INDEX_COLUMNS, ignore_index=True)
+        return self.df
+
+    @stage("transform_facets")
     def transform(self):
+        if self.columnar:
+            return self._transform_columnar()
+        if self.chunk_size is not None:
+            return self._transform_chunked()
+
         self._parse_entries()
         self._replace_item_ids_with_values()
         self._map_ids()
-        print(self.df)
+        logger.debug("FACETS data in long format:\n%s", self.df)
         self._transpose_items()
         return self.df
-        
-        
+
+
+
+def _transform_export(path, chunk_size, locale, lookup_tables, exclude_entry_ids):
+    # Task of transform_exports, runs in a worker process
+    formatter = FACETSFormatter.from_file(
+        path, chunk_size=chunk_size, locale=locale, lookup_tables=lookup_tables, exclude_entry_ids=exclude_entry_ids)
+    return formatter.transform(), formatter.entry_ids
+
+def combine_exports(frames):
+    '''Transformed exports as one frame, with the columns and row order of a single export.
+    An entry delivered in several exports is kept once, from the latest export
+    (Entry IDs include last_updated_at, so an entry updated since is a new entry).
+    frames are in delivery order.'''
+    df = pd.concat(frames, ignore_index=True)
+    # Stable sort, duplicates have the same Time and stay in delivery order
+    df = df.sort_values("Time", kind="stable").drop_duplicates("Entry ID", keep="last")
+    item_cols = sorted(x for x in df.columns if x not in INDEX_COLUMNS)
+    return df[INDEX_COLUMNS + item_cols].sort_values(INDEX_COLUMNS, ignore_index=True)
+
+def transform_exports(paths, chunk_size=1000, locale="en", n_workers=1, exclude_entry_ids=None):
+    '''Transforms several FACETS exports (e.g. one per clinic and day) in worker
+    processes, one export per task, each streamed in chunks of chunk_size entries.
+    paths are in delivery order, see combine_exports. Entries with an Entry ID in
+    exclude_entry_ids are skipped (incremental mode). Returns the transformed entries
+    and the Entry IDs of all entries in the exports, also the skipped ones.'''
+    if len(paths) == 0:
+        raise FileNotFoundError("No FACETS exports to transform")
+    # Compiled once here, workers get the tables with their task
+    lookup_tables = LookupTables.load()
+    tasks = [(path, chunk_size, locale, lookup_tables, exclude_entry_ids) for path in paths]
+    with stage("transform_exports", exports=len(paths)) as s:
+        with SharedPool({}, n_workers=max(1, min(n_workers, len(paths)))) as pool:
+            frames, entry_ids = zip(*pool.map(_transform_export, tasks))
+        df = combine_exports(frames) if len(frames) > 1 else frames[0]
+        return s.record(df), [entry_id for ids in entry_ids for entry_id in ids]
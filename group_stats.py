@@ -0,0 +1,171 @@
+import pandas as pd
+import numpy as np
+from scipy import stats
+
+QUANTILES = [0.25, 0.5, 0.75]
+# Columns of group_comparison_table
+COMPARISON_COLUMNS = (
+    ["Group", "Item", "N in", "N out", "Mean in", "Mean out"]
+    + [f"Q{int(quantile*100)} {side}" for quantile in QUANTILES for side in ["in", "out"]]
+    + ["U", "Z", "U PVal", "Rank biserial", "t", "t DF", "t PVal", "Cohen d", "U PVal FDR", "t PVal FDR", "Significant"]
+)
+
+def fdr_bh(pvals):
+    '''Benjamini-Hochberg adjusted p-values, NaN p-values are left out and stay NaN'''
+    pvals = np.asarray(pvals, dtype=float)
+    adjusted = np.full(pvals.shape, np.nan)
+    tested = ~np.isnan(pvals)
+    p = pvals[tested]
+    order = np.argsort(p)
+    scaled = p[order] * len(p) / np.arange(1, len(p)+1)
+    # Running minimum from the largest p-value down keeps adjusted p-values monotone
+    scaled = np.minimum.accumulate(scaled[::-1])[::-1]
+    adjusted_tested = np.empty(len(p))
+    adjusted_tested[order] = np.minimum(scaled, 1)
+    adjusted[tested] = adjusted_tested
+    return adjusted
+
+def group_quantiles(X, groups, quantiles=QUANTILES):
+    '''Quantiles (linear interpolation, like np.quantile) of every column of X (n x items)
+    in every group column of groups (n x g, boolean), each column of X is sorted once.
+    Returns an array (quantiles x g x items).'''
+    result = np.full((len(quantiles), groups.shape[1], X.shape[1]), np.nan)
+    for j in range(X.shape[1]):
+        observed = ~np.isnan(X[:, j])
+        if not observed.any():
+            continue
+        order = np.argsort(X[observed, j])
+        values = X[observed, j][order]
+        # Number of group members up to every position in sorted order
+        cumulative = np.cumsum(groups[observed][order], axis=0)
+        n = cumulative[-1]
+
+        for q, quantile in enumerate(quantiles):
+            h = (n - 1) * quantile
+            low = np.floor(h).astype(int)
+            high = np.minimum(low + 1, n - 1)
+            # Position of the low-th and high-th member of every group in sorted order
+            low_value = values[np.minimum((cumulative < low[None] + 1).sum(axis=0), len(values) - 1)]
+            high_value = values[np.minimum((cumulative < high[None] + 1).sum(axis=0), len(values) - 1)]
+            result[q, :, j] = np.where(n > 0, low_value + (h - low)*(high_value - low_value), np.nan)
+    return result
+
+def _masked_moments(X, groups):
+    # Counts, means and variances (ddof=1) of every column of X in every group, with matrix products
+    observed = ~np.isnan(X)
+    values = np.where(observed, X, 0)
+    groups = groups.astype(float)
+    n = groups.T @ observed
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (groups.T @ values) / n
+        var = ((groups.T @ values**2) - n*mean**2) / (n - 1)
+    return n, mean, var
+
+def compare_groups(X, in_group):
+    '''Mann-Whitney U test (normal approximation with tie and continuity correction,
+    like scipy.stats.mannwhitneyu(method="asymptotic")), Welch t-test, rank-biserial
+    correlation and Cohen's d of every column of X (n x items) between rows in and
+    out of every group column of in_group (n x g, boolean, all rows have a group).
+    Columns of X are ranked once for all groups. Returns a dict of (g x items) arrays.'''
+    observed = ~np.isnan(X)
+    n = observed.sum(axis=0)
+    ranks = np.nan_to_num(stats.rankdata(X, axis=0, nan_policy="omit"))
+
+    # Sum of t^3 - t over ties from the sum of squared midranks
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ties = 12 * (n*(n + 1)*(2*n + 1)/6 - (ranks**2).sum(axis=0))
+
+    groups = in_group.astype(float)
+    n1 = groups.T @ observed
+    n2 = n[None] - n1
+    rank_sum = groups.T @ ranks
+
+    u1 = rank_sum - n1*(n1 + 1)/2
+    u2 = n1*n2 - u1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = n1*n2/2
+        sd = np.sqrt(n1*n2/12 * ((n + 1) - ties/(n*(n - 1))))
+        z = (np.maximum(u1, u2) - mu - 0.5) / sd
+        u_pval = np.clip(2 * stats.norm.sf(z), 0, 1)
+        rank_biserial = 2*u1/(n1*n2) - 1
+
+    n_in, mean_in, var_in = _masked_moments(X, in_group)
+    n_out, mean_out, var_out = _masked_moments(X, ~in_group)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        se_in, se_out = var_in/n_in, var_out/n_out
+        t = (mean_in - mean_out) / np.sqrt(se_in + se_out)
+        t_df = (se_in + se_out)**2 / (se_in**2/(n_in - 1) + se_out**2/(n_out - 1))
+        t_pval = 2 * stats.t.sf(np.abs(t), t_df)
+        pooled_sd = np.sqrt(((n_in - 1)*var_in + (n_out - 1)*var_out) / (n_in + n_out - 2))
+        cohen_d = (mean_in - mean_out) / pooled_sd
+
+    return {
+        "n_in": n_in, "n_out": n_out, "mean_in": mean_in, "mean_out": mean_out,
+        "u": u1, "z": z, "u_pval": u_pval, "rank_biserial": rank_biserial,
+        "t": t, "t_df": t_df, "t_pval": t_pval, "cohen_d": cohen_d
+    }
+
+def group_comparison_table(data, items, group_cols, alpha=0.05):
+    '''Every item (e.g. FACETS) compared between rows with and without every group
+    (e.g. "Diag." columns, non-zero is in the group), one row per group and item.
+    Rows with a missing group value are left out for that group; groups with the same
+    missing rows share the ranking and sorting of the items.
+    p-values are FDR corrected (Benjamini-Hochberg) over all pairs.'''
+    X = data[items].to_numpy(dtype=float)
+    G = data[group_cols].to_numpy(dtype=float)
+
+    # Group columns by their pattern of missing values
+    patterns = {}
+    for g, col in enumerate(group_cols):
+        patterns.setdefault(np.isnan(G[:, g]).tobytes(), []).append(g)
+
+    tables = []
+    for pattern_groups in patterns.values():
+        rows = ~np.isnan(G[:, pattern_groups[0]])
+        in_group = G[rows][:, pattern_groups] != 0
+        X_rows = X[rows]
+
+        result = compare_groups(X_rows, in_group)
+        quantiles_in = group_quantiles(X_rows, in_group)
+        quantiles_out = group_quantiles(X_rows, ~in_group)
+
+        table = {
+            "Group": np.repeat([group_cols[g] for g in pattern_groups], len(items)),
+            "Item": np.tile(items, len(pattern_groups)),
+            "N in": result["n_in"].ravel().astype(int),
+            "N out": result["n_out"].ravel().astype(int),
+            "Mean in": result["mean_in"].ravel(),
+            "Mean out": result["mean_out"].ravel(),
+        }
+        for q, quantile in enumerate(QUANTILES):
+            table[f"Q{int(quantile*100)} in"] = quantiles_in[q].ravel()
+            table[f"Q{int(quantile*100)} out"] = quantiles_out[q].ravel()
+        table.update({
+            "U": result["u"].ravel(),
+            "Z": result["z"].ravel(),
+            "U PVal": result["u_pval"].ravel(),
+            "Rank biserial": result["rank_biserial"].ravel(),
+            "t": result["t"].ravel(),
+            "t DF": result["t_df"].ravel(),
+            "t PVal": result["t_pval"].ravel(),
+            "Cohen d": result["cohen_d"].ravel(),
+        })
+        tables.append(pd.DataFrame(table))
+
+    if len(tables) == 0:
+        # No group columns (e.g. an export without diagnoses)
+        return pd.DataFrame(columns=COMPARISON_COLUMNS)
+    table = pd.concat(tables, ignore_index=True)
+    # Same order as group_cols x items
+    table = table.set_index(["Group", "Item"]).loc[pd.MultiIndex.from_product([group_cols, items])]
+    table = table.rename_axis(["Group", "Item"]).reset_index()
+
+    table["U PVal FDR"] = fdr_bh(table["U PVal"])
+    table["t PVal FDR"] = fdr_bh(table["t PVal"])
+    table["Significant"] = table["U PVal FDR"] < alpha
+    return table
+
+def significant_pairs(table, pval_col="U PVal FDR", alpha=0.05):
+    # (group, item) pairs to plot
+    significant = table[table[pval_col] < alpha]
+    return list(zip(significant["Group"], significant["Item"]))
@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+from scipy.stats import f
+
+ICC_TYPES = ["ICC1", "ICC2", "ICC3", "ICC1k", "ICC2k", "ICC3k"]
+
+def rating_tensor(df, targets, raters, items):
+    '''Wide (targets x raters x items) array of ratings from a long df with one row
+    per target and rater. Repeated ratings of a target by the same rater are averaged.
+    Returns the array and the target and rater labels.'''
+    target_codes, target_labels = pd.factorize(df[targets])
+    rater_codes, rater_labels = pd.factorize(df[raters])
+    tensor = tensor_from_codes(target_codes, rater_codes, df[items].to_numpy(dtype=float))
+    return tensor, target_labels, rater_labels
+
+def tensor_from_codes(target_codes, rater_codes, values):
+    '''Same as rating_tensor for integer target and rater codes (-1 is missing)
+    and an (n x items) array of ratings'''
+    # Rows without target or rater are not ratings
+    labelled = (target_codes >= 0) & (rater_codes >= 0)
+    target_codes, rater_codes, values = target_codes[labelled], rater_codes[labelled], values[labelled]
+
+    shape = (target_codes.max(initial=-1)+1, rater_codes.max(initial=-1)+1, values.shape[1])
+    sums = np.zeros(shape)
+    counts = np.zeros(shape)
+    observed = ~np.isnan(values)
+    np.add.at(sums, (target_codes, rater_codes), np.where(observed, values, 0))
+    np.add.at(counts, (target_codes, rater_codes), observed)
+
+    with np.errstate(invalid="ignore"):
+        return sums / counts
+
+def mean_squares(x):
+    '''Two-way ANOVA mean squares for every item at once.
+    x is (..., targets, raters, items), leading dimensions are batches (e.g. resamples).
+    Per item, only targets rated by all raters are used, like pingouin's nan_policy="omit".'''
+    k = x.shape[-2]
+    complete = ~np.isnan(x).any(axis=-2)
+    n = complete.sum(axis=-2)
+    x = np.where(complete[..., None, :], x, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        grand_mean = x.sum(axis=(-3, -2)) / (n*k)
+        target_means = x.sum(axis=-2) / k
+        rater_means = x.sum(axis=-3) / n[..., None, :]
+
+        ss_total = np.where(complete[..., None, :], (x - grand_mean[..., None, None, :])**2, 0).sum(axis=(-3, -2))
+        ss_targets = k * np.where(complete, (target_means - grand_mean[..., None, :])**2, 0).sum(axis=-2)
+        ss_raters = n * ((rater_means - grand_mean[..., None, :])**2).sum(axis=-2)
+        ss_error = ss_total - ss_targets - ss_raters
+
+        return {
+            "n": n,
+            "k": k,
+            "msr": ss_targets / (n - 1),
+            "msc": ss_raters / (k - 1),
+            "mse": ss_error / ((n - 1) * (k - 1)),
+            "msw": (ss_raters + ss_error) / (n * (k - 1))
+        }
+
+def icc_values(ms):
+    '''Point estimates only, (..., 6, items) in ICC_TYPES order, from mean_squares(x).
+    Cheaper than icc() when the tests and intervals are not needed (e.g. resamples).'''
+    n, k = ms["n"], ms["k"]
+    msr, msc, mse, msw = ms["msr"], ms["msc"], ms["mse"], ms["msw"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.stack(np.broadcast_arrays(
+            (msr - msw) / (msr + (k - 1)*msw),
+            (msr - mse) / (msr + (k - 1)*mse + k*(msc - mse)/n),
+            (msr - mse) / (msr + (k - 1)*mse),
+            (msr - msw) / msr,
+            (msr - mse) / (msr + (msc - mse)/n),
+            (msr - mse) / msr
+        ), axis=-2)
+
+def icc(x, alpha=0.05):
+    '''ICC1, ICC2, ICC3 (single) and ICC1k, ICC2k, ICC3k (average) with F-tests and
+    confidence intervals for all items of a (..., targets, raters, items) array at once,
+    using the formulas of pingouin.intraclass_corr.
+    Returns a dict of arrays per statistic, each (..., 6, items) in ICC_TYPES order.'''
+    ms = mean_squares(x)
+    n, k = ms["n"], ms["k"]
+    msr, msc, mse, msw = ms["msr"], ms["msc"], ms["mse"], ms["msw"]
+
+    values = icc_values(ms)
+    icc2 = values[..., 1, :]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+
+        # F-tests, ICC2 and ICC3 share the test
+        df1 = n - 1
+        df1_within = n * (k - 1)
+        df2_error = (n - 1) * (k - 1)
+        f1 = msr / msw
+        f3 = msr / mse
+        p1 = f.sf(f1, df1, df1_within)
+        p3 = f.sf(f3, df1, df2_error)
+
+        # Confidence intervals, ICC1 and ICC3
+        f1_low = f1 / f.ppf(1 - alpha/2, df1, df1_within)
+        f1_high = f1 * f.ppf(1 - alpha/2, df1_within, df1)
+        f3_low = f3 / f.ppf(1 - alpha/2, df1, df2_error)
+        f3_high = f3 * f.ppf(1 - alpha/2, df2_error, df1)
+
+        # ICC2, Satterthwaite approximation of the degrees of freedom
+        fj = msc / mse
+        vn = df2_error * (k*icc2*fj + n*(1 + (k - 1)*icc2) - k*icc2)**2
+        vd = df1 * k**2 * icc2**2 * fj**2 + (n*(1 + (k - 1)*icc2) - k*icc2)**2
+        v = vn / vd
+        f2_high = f.ppf(1 - alpha/2, n - 1, v)
+        f2_low = f.ppf(1 - alpha/2, v, n - 1)
+        low2 = n*(msr - f2_high*mse) / (f2_high*(k*msc + (k*n - k - n)*mse) + n*msr)
+        high2 = n*(f2_low*msr - mse) / (k*msc + (k*n - k - n)*mse + n*f2_low*msr)
+
+        ci_low = [
+            (f1_low - 1) / (f1_low + k - 1),
+            low2,
+            (f3_low - 1) / (f3_low + k - 1),
+            1 - 1/f1_low,
+            low2*k / (1 + low2*(k - 1)),
+            1 - 1/f3_low
+        ]
+        ci_high = [
+            (f1_high - 1) / (f1_high + k - 1),
+            high2,
+            (f3_high - 1) / (f3_high + k - 1),
+            1 - 1/f1_high,
+            high2*k / (1 + high2*(k - 1)),
+            1 - 1/f3_high
+        ]
+
+    stack = lambda values: np.stack(np.broadcast_arrays(*values), axis=-2)
+    return {
+        "ICC": values,
+        "F": stack([f1, f3, f3, f1, f3, f3]),
+        "df1": stack([df1]*6),
+        "df2": stack([df1_within, df2_error, df2_error, df1_within, df2_error, df2_error]),
+        "pval": stack([p1, p3, p3, p1, p3, p3]),
+        "ci_low": stack(ci_low),
+        "ci_high": stack(ci_high),
+        "n": n
+    }
+
+def icc_table(df, items, targets="Study ID", raters="Respondent Hash", alpha=0.05):
+    '''All ICC types for all items of a long df, one row per item and type'''
+    tensor, _, _ = rating_tensor(df, targets, raters, items)
+    result = icc(tensor, alpha=alpha)
+
+    n_types = len(ICC_TYPES)
+    return pd.DataFrame({
+        "Item": np.tile(items, n_types),
+        "Type": np.repeat(ICC_TYPES, len(items)),
+        "ICC": result["ICC"].ravel(),
+        "F": result["F"].ravel(),
+        "df1": result["df1"].ravel(),
+        "df2": result["df2"].ravel(),
+        "PVal": result["pval"].ravel(),
+        "CI low": result["ci_low"].ravel(),
+        "CI high": result["ci_high"].ravel()
+    })
@@ -0,0 +1,141 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows, peak RSS is not available
+    resource = None
+
+# Paths to write stage records to, set by the caller (e.g. pipeline.py per step)
+METRICS_ENV = "PIPELINE_METRICS" # JSON lines, one record per stage
+TRACE_ENV = "PIPELINE_TRACE" # Trace event JSON, opens in chrome://tracing or Perfetto
+LOG_LEVEL_ENV = "LOG_LEVEL"
+
+logger = logging.getLogger(__name__)
+
+_trace_events = []
+_lock = threading.Lock()
+_local = threading.local()
+
+def configure_logging(level=None):
+    '''Log records of all modules to stdout, at LOG_LEVEL (INFO by default).
+    Called once by the scripts, library modules only get loggers.'''
+    level = level or os.environ.get(LOG_LEVEL_ENV, "INFO")
+    logging.basicConfig(stream=sys.stdout, level=level.upper(), format="%(message)s")
+
+def rss_mb():
+    # Current resident set size, Linux only
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb():
+    # Peak resident set size of the process so far, ru_maxrss is in kB on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def _write_trace():
+    path = os.environ.get(TRACE_ENV)
+    if path and _trace_events:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": _trace_events, "displayTimeUnit": "ms"}, f)
+
+atexit.register(_write_trace)
+
+def emit(record):
+    '''Sends a stage record to the log (DEBUG), the metrics file and the trace'''
+    logger.debug(
+        "%s: %.3fs, %s rows, %s cols, peak RSS %s MB",
+        record["stage"], record["seconds"], record["rows"], record["cols"], record["peak_rss_mb"])
+
+    metrics_path = os.environ.get(METRICS_ENV)
+    with _lock:
+        if metrics_path:
+            with open(metrics_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if os.environ.get(TRACE_ENV):
+            _trace_events.append({
+                "name": record["stage"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["seconds"] * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {key: value for key, value in record.items() if key not in ("stage", "start", "seconds")}
+            })
+
+class stage():
+    '''Records wall time, RSS, output size and throughput of one pipeline stage.
+    As a context manager, call record() with the output (anything with a shape, or rows/cols):
+
+        with stage("pivot") as s:
+            df = ...
+            s.record(df)
+
+    As a decorator, the return value of the function is recorded when it has a shape:
+
+        @stage("merge")
+        def merge_sources(...):
+
+    Stages can be nested, records name their parent stage.'''
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.rows = None
+        self.cols = None
+
+    def record(self, output=None, rows=None, cols=None):
+        shape = getattr(output, "shape", None)
+        if shape is not None:
+            rows = shape[0]
+            cols = shape[1] if len(shape) > 1 else None
+        self.rows = rows if rows is not None else self.rows
+        self.cols = cols if cols is not None else self.cols
+        return output
+
+    def __enter__(self):
+        self.parents = getattr(_local, "stages", [])
+        _local.stages = self.parents + [self.name]
+        self.rss_start = rss_mb()
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.perf_start
+        _local.stages = self.parents
+        rss = rss_mb()
+        emit({
+            "stage": self.name,
+            "parent": self.parents[-1] if self.parents else None,
+            "start": self.start,
+            "seconds": seconds,
+            "rows": self.rows,
+            "cols": self.cols,
+            "rows_per_second": self.rows / seconds if self.rows is not None and seconds > 0 else None,
+            "rss_mb": rss,
+            "rss_delta_mb": rss - self.rss_start if rss is not None and self.rss_start is not None else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "failed": exc_type is not None,
+            **self.fields
+        })
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(self.name, **self.fields) as s:
+                return s.record(func(*args, **kwargs))
+        return wrapper
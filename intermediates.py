@@ -0,0 +1,79 @@
+import pandas as pd
+import os
+
+from instrumentation import stage
+
+DATA_DIR = "data/"
+
+# Binary formats keep dtypes and can be read column by column, csv is kept for export
+FORMATS = {
+    "csv": ".csv",
+    "feather": ".feather",
+    "parquet": ".parquet"
+}
+
+def _path(name, format, data_dir):
+    return os.path.join(data_dir, name+FORMATS[format])
+
+def find_intermediate(name, data_dir=DATA_DIR):
+    '''Returns the format of the most recently written file of an artifact'''
+    written = []
+    for format in FORMATS:
+        path = _path(name, format, data_dir)
+        if os.path.exists(path):
+            written.append((os.path.getmtime(path), format))
+    if len(written) == 0:
+        raise FileNotFoundError(f"No {name} file in {data_dir}, run data_preprocessing.py first")
+    return max(written)[1]
+
+def intermediate_path(name, format=None, data_dir=DATA_DIR):
+    # Path of the file of an artifact, the most recently written one without format
+    return _path(name, format or find_intermediate(name, data_dir), data_dir)
+
+def write_intermediate(df, name, format="csv", data_dir=DATA_DIR):
+    path = _path(name, format, data_dir)
+    with stage("write", file=name, format=format) as s:
+        s.record(df)
+        if format == "csv":
+            df.to_csv(path)
+        elif format == "feather":
+            # Uncompressed so reads can be memory-mapped without decompressing
+            df.reset_index(drop=True).to_feather(path, compression="uncompressed")
+        elif format == "parquet":
+            df.to_parquet(path, index=False)
+    return path
+
+def intermediate_columns(name, format=None, data_dir=DATA_DIR):
+    '''Column names of an artifact, without reading its data'''
+    format = format or find_intermediate(name, data_dir)
+    path = _path(name, format, data_dir)
+    if format == "csv":
+        return list(pd.read_csv(path, index_col=0, nrows=0).columns)
+    elif format == "feather":
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).schema.names
+    elif format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+
+def read_intermediate(name, columns=None, format=None, data_dir=DATA_DIR):
+    '''Reads an artifact written by write_intermediate. Without format the most
+    recently written file is used. Only `columns` are loaded if given.
+    Binary files are memory-mapped, so unused columns are never read from disk.'''
+    format = format or find_intermediate(name, data_dir)
+    path = _path(name, format, data_dir)
+
+    if format == "csv":
+        if columns is None:
+            return pd.read_csv(path, index_col=0)
+        header = pd.read_csv(path, index_col=0, nrows=0).columns
+        usecols = [0] + [header.get_loc(col)+1 for col in columns]
+        return pd.read_csv(path, index_col=0, usecols=usecols)[columns]
+    elif format == "feather":
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    elif format == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=True)
+
+    return table.to_pandas(split_blocks=True, self_destruct=True)
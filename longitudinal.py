@@ -0,0 +1,166 @@
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+import os
+
+from aggregation import SortedGroups
+from facets_preprocessing import INDEX_COLUMNS
+from intermediates import read_intermediate
+from instrumentation import configure_logging, stage
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = "output/longitudinal/"
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+
+def utc_seconds(times):
+    # Times (strings or timestamps, as a Series) as datetime64 seconds in UTC
+    return pd.to_datetime(times, utc=True).dt.tz_convert(None).to_numpy().astype("datetime64[s]")
+
+class TimeIndex():
+    '''FACETS entries of every subject in time order. Entries are sorted once by
+    subject and Time into one (entries x items) array, the entries of subject i are
+    rows offsets[i]:offsets[i+1]. Computations over all subjects are reductions
+    over these blocks (ufunc.reduceat) or one searchsorted, without regrouping.
+    Subjects are the distinct values of key (Study ID by default) in sorted order.
+
+        index = TimeIndex(read_intermediate("facets_transformed"))
+        index.change_scores()
+        index.latest_before("2024-06-01")'''
+
+    def __init__(self, entries, items=None, key="Study ID"):
+        self.items = items if items is not None else [col for col in entries.columns if col not in INDEX_COLUMNS]
+        self.key = key
+        entries = entries[entries[key].notna()]
+        codes, subjects = pd.factorize(entries[key], sort=True)
+        self.subjects = pd.Index(subjects, name=key)
+        seconds = utc_seconds(entries["Time"]).astype(np.int64)
+
+        # Sorted by time first, the stable sort by subject keeps every subject's entries in time order
+        by_time = np.argsort(seconds, kind="stable")
+        groups = SortedGroups(codes[by_time])
+        order = by_time[groups.order]
+        self.offsets = np.r_[groups.starts, len(order)].astype(np.int64)
+
+        self.seconds = seconds[order]
+        self.values = entries[self.items].to_numpy(dtype=float)[order]
+        self.entry_ids = entries["Entry ID"].to_numpy()[order]
+        self.subject_codes = codes[order] # Subject of every sorted entry
+
+    @classmethod
+    def from_intermediate(cls, items=None, key="Study ID"):
+        return cls(read_intermediate("facets_transformed"), items=items, key=key)
+
+    @property
+    def n_entries(self):
+        return pd.Series(np.diff(self.offsets), index=self.subjects, name="Entries")
+
+    @property
+    def times(self):
+        return pd.to_datetime(self.seconds, unit="s", utc=True)
+
+    def entries(self, subject):
+        # Entries of one subject in time order
+        i = self.subjects.get_loc(subject)
+        rows = slice(self.offsets[i], self.offsets[i+1])
+        df = pd.DataFrame(self.values[rows], columns=self.items)
+        df.insert(0, "Time", self.times[rows])
+        df.insert(0, "Entry ID", self.entry_ids[rows])
+        return df
+
+    def _frame(self, values):
+        return pd.DataFrame(values, index=self.subjects, columns=self.items)
+
+    def _observed_positions(self):
+        # Rows of the first and last observed value of every item per subject, -1 where none is observed
+        observed = ~np.isnan(self.values)
+        rows = np.arange(len(self.values))[:, None]
+        starts = self.offsets[:-1]
+        first = np.minimum.reduceat(np.where(observed, rows, len(self.values)), starts, axis=0)
+        last = np.maximum.reduceat(np.where(observed, rows, -1), starts, axis=0)
+        found = first < self.offsets[1:, None]
+        return np.where(found, first, -1), np.where(found, last, -1)
+
+    def change_scores(self):
+        '''Last minus first observed value of every item per subject,
+        NaN where an item was observed in fewer than two entries'''
+        first, last = self._observed_positions()
+        columns = np.arange(len(self.items))
+        with np.errstate(invalid="ignore"):
+            change = self.values[last, columns] - self.values[first, columns]
+        return self._frame(np.where((first >= 0) & (last > first), change, np.nan))
+
+    def slopes(self, min_entries=2):
+        '''Least squares slope of every item over time (change per year) per subject,
+        from sums over every subject's block of entries. Times are relative to the
+        subject's first entry. NaN where an item was observed in fewer than
+        min_entries entries or all at the same time.'''
+        starts = self.offsets[:-1]
+        t = ((self.seconds - self.seconds[starts][self.subject_codes]) / SECONDS_PER_YEAR)[:, None]
+
+        observed = ~np.isnan(self.values)
+        y = np.where(observed, self.values, 0)
+        t = np.where(observed, t, 0)
+        n = np.add.reduceat(observed, starts, axis=0)
+        sum_t = np.add.reduceat(t, starts, axis=0)
+        sum_y = np.add.reduceat(y, starts, axis=0)
+        sum_ty = np.add.reduceat(t*y, starts, axis=0)
+        sum_tt = np.add.reduceat(t*t, starts, axis=0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = n*sum_tt - sum_t**2
+            slope = (n*sum_ty - sum_t*sum_y) / variance
+        return self._frame(np.where((n >= min_entries) & (variance > 1e-12), slope, np.nan))
+
+    def latest_before(self, dates):
+        '''Latest entry at or before dates of every subject, dates is one date or a
+        Series of dates indexed by subject (e.g. the SDQ assessment dates).
+        One searchsorted over (subject, time) keys for all subjects. Subjects without
+        an entry by then (or without a date) get NaN.'''
+        if isinstance(dates, pd.Series):
+            dates = dates.reindex(self.subjects)
+        else:
+            dates = pd.Series(dates, index=self.subjects)
+        query = utc_seconds(dates)
+        has_date = ~np.isnat(query)
+        query_seconds = np.where(has_date, query.astype(np.int64), 0)
+
+        # Every subject's times in their own range of keys, keys are sorted like the entries.
+        # Dates are clipped to the range, before the first entry lands in the previous subject's range.
+        low = self.seconds.min()
+        span = self.seconds.max() - low + 2
+        keys = self.subject_codes * span + (self.seconds - low)
+        query_keys = np.arange(len(self.subjects)) * span + np.clip(query_seconds - low, -1, span - 2)
+
+        rows = np.searchsorted(keys, query_keys, side="right") - 1
+        found = has_date & (rows >= self.offsets[:-1])
+        rows = np.where(found, rows, 0)
+
+        df = self._frame(np.where(found[:, None], self.values[rows], np.nan))
+        df.insert(0, "Time", pd.Series(self.times[rows], index=self.subjects).where(found))
+        df.insert(0, "Entry ID", pd.Series(self.entry_ids[rows], index=self.subjects).where(found))
+        return df
+
+@stage("longitudinal")
+def run(before=None, key="Study ID"):
+    index = TimeIndex.from_intermediate(key=key)
+    repeated = (index.n_entries > 1).sum()
+    logger.info("%d subjects, %d with repeated assessments", len(index.subjects), repeated)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    index.n_entries.to_csv(f"{OUTPUT_DIR}entries.csv")
+    index.change_scores().to_csv(f"{OUTPUT_DIR}change_scores.csv")
+    index.slopes().to_csv(f"{OUTPUT_DIR}slopes.csv")
+    if before is not None:
+        index.latest_before(before).to_csv(f"{OUTPUT_DIR}latest_before.csv")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Change scores and slopes of the FACETS items of subjects with repeated assessments")
+    parser.add_argument("--before", help="Also write the latest entry of every subject at or before this date")
+    parser.add_argument("--key", default="Study ID", help="Column identifying subjects")
+    args = parser.parse_args()
+    configure_logging()
+
+    run(before=args.before, key=args.key)
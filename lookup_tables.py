@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+
+from preprocessing_cache import CACHE_DIR
+
+ITEM_TRANSLATION_PATH = "facets_item_translation.csv"
+ID_MAPPING_PATH = "data/id_mapping_facets.csv"
+LOOKUP_PATH = os.path.join(CACHE_DIR, "lookup_tables.pkl")
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+class LookupTables():
+    '''Item UUID -> column name (slug) in every locale and Subject UUID -> Study ID,
+    compiled once from the item translation and the ID mapping and cached on disk.
+    The cache is compiled again when the content of a source file changes, sources
+    are only hashed again when their size or modification time changed.
+    IDs are factorized first, so every distinct ID is looked up once and rows get
+    the result by integer code.'''
+
+    def __init__(self, item_ids, slugs, subject_ids, study_ids, sources=None):
+        self.item_ids = item_ids # pd.Index of item UUIDs, the item codes
+        self.slugs = slugs # {locale: slug of every item code, NaN where the item has no translation}
+        self.subject_ids = subject_ids # pd.Index of subject UUIDs, the subject codes
+        self.study_ids = study_ids # Study ID of every subject code
+        self.sources = sources or {} # {path: [mtime_ns, size, sha256]} the tables were compiled from
+
+    @classmethod
+    def compile(cls, translation_path=ITEM_TRANSLATION_PATH, id_mapping_path=ID_MAPPING_PATH):
+        translation = pd.read_csv(translation_path, sep=",")
+        item_ids = pd.Index(translation["assessment_item_id"].drop_duplicates())
+        slugs = {}
+        for locale, rows in translation.groupby("locale_code", sort=True):
+            rows = rows.drop_duplicates("assessment_item_id")
+            locale_slugs = np.full(len(item_ids), np.nan, dtype=object)
+            locale_slugs[item_ids.get_indexer(rows["assessment_item_id"])] = rows["slug"].to_numpy()
+            slugs[locale] = locale_slugs
+
+        id_mapping = pd.read_csv(id_mapping_path)
+        id_mapping = id_mapping.drop_duplicates("subject_id")
+        return cls(
+            item_ids, slugs, pd.Index(id_mapping["subject_id"]), id_mapping["dislay_label"].to_numpy())
+
+    @classmethod
+    def load(cls, path=LOOKUP_PATH, translation_path=ITEM_TRANSLATION_PATH, id_mapping_path=ID_MAPPING_PATH):
+        '''Tables from the cache at path, compiled and cached again if a source changed'''
+        cached = cls._read(path) if os.path.exists(path) else None
+        previous_sources = cached.sources if cached is not None else {}
+
+        sources = {}
+        changed = cached is None
+        for source in [translation_path, id_mapping_path]:
+            stat = os.stat(source)
+            previous = previous_sources.get(source)
+            if previous is not None and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+                sources[source] = previous
+                continue
+            sources[source] = [stat.st_mtime_ns, stat.st_size, file_digest(source)]
+            changed = changed or previous is None or previous[2] != sources[source][2]
+
+        tables = cls.compile(translation_path, id_mapping_path) if changed else cached
+        if tables.sources != sources:
+            tables.sources = sources
+            tables.save(path)
+        return tables
+
+    @classmethod
+    def _read(cls, path):
+        try:
+            stored = pd.read_pickle(path)
+        except Exception:
+            # Unreadable cache (e.g. interrupted write), compiled again
+            return None
+        return cls(stored["item_ids"], stored["slugs"], stored["subject_ids"], stored["study_ids"], stored["sources"])
+
+    def save(self, path=LOOKUP_PATH):
+        # Written to a temporary file first, processes loading the tables at the same time never see half a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pd.to_pickle({
+            "item_ids": self.item_ids,
+            "slugs": self.slugs,
+            "subject_ids": self.subject_ids,
+            "study_ids": self.study_ids,
+            "sources": self.sources
+        }, tmp_path)
+        os.replace(tmp_path, path)
+
+    def source_digest(self, path=ITEM_TRANSLATION_PATH):
+        # sha256 of a source file the tables were compiled from
+        return self.sources[path][2]
+
+    def locale_slugs(self, locale):
+        if locale not in self.slugs:
+            raise KeyError(f"No item translation for locale {locale}, locales are {', '.join(self.slugs)}")
+        return self.slugs[locale]
+
+    def item_names(self, locale="en"):
+        '''Slugs of the items translated in locale, indexed by item UUID'''
+        slugs = self.locale_slugs(locale)
+        translated = pd.notna(slugs)
+        return pd.Series(slugs[translated], index=self.item_ids[translated], name="slug")
+
+    def translate_items(self, item_ids, locale="en"):
+        '''Column names of item_ids (a Series) in locale, IDs without a translation are kept'''
+        codes, uniques = pd.factorize(item_ids.to_numpy(dtype=object))
+        positions = self.item_ids.get_indexer(uniques)
+        slugs = self.locale_slugs(locale)[positions]
+        names = np.where((positions >= 0) & pd.notna(slugs), slugs, uniques)
+        # Code -1 (missing ID) takes the NaN appended last
+        return pd.Series(np.append(names, np.nan)[codes], index=item_ids.index)
+
+    def map_subjects(self, subject_ids):
+        '''Study IDs of subject_ids (a Series), NaN where a subject is not in the ID mapping'''
+        codes, uniques = pd.factorize(subject_ids.to_numpy(dtype=object))
+        # Subjects not in the mapping and missing subject IDs take the NaN appended last
+        positions = np.append(self.subject_ids.get_indexer(uniques), -1)
+        study_ids = np.append(self.study_ids.astype(object), np.nan)
+        return pd.Series(study_ids[positions[codes]], index=subject_ids.index).infer_objects()
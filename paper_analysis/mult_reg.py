@@ -1,15 +1,22 @@
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
+import argparse
+import logging
 
+from intermediates import intermediate_columns, read_intermediate
+from regression import fit_ols
+from resampling import bootstrap_ols
+from regularized import PENALTIES, fit_regularized
+from instrumentation import configure_logging, stage
+
+logger = logging.getLogger(__name__)
+
+@stage("ols")
 def run_ols(data, facets_cols, sdq_subscales):
-    results = {}
-    for subscale in sdq_subscales:
-        mod = sm.OLS(data[subscale], data[facets_cols])
-        result = mod.fit()
-        results[subscale] = result
-        print(subscale, result.summary())
-    return results
+    # All subscales are fitted on the same design matrix at once
+    coefs, fit = fit_ols(data, facets_cols, sdq_subscales)
+    logger.info("%s", fit)
+    return coefs, fit
 
 def write_results_to_csv(results):
     import os   
@@ -17,26 +24,54 @@ def write_results_to_csv(results):
     if not os.path.exists(dir):
         os.makedirs(dir)
 
-    for subscale in results:
-
+    coefs, fit = results
+    for subscale, subscale_coefs in coefs.groupby("Subscale", sort=False):
         file_name = f"{dir}{subscale}_full.csv" 
-        with open(file_name, 'w') as f:
-            f.write(results[subscale].summary().as_csv())
+        subscale_coefs.drop("Subscale", axis=1).to_csv(file_name, index=False)
+    fit.to_csv(f"{dir}fit.csv", index=False)
 
-            # Read and reformat as df
-            df = pd.read_csv(file_name)
-            print(df)
+@stage("ols_bootstrap")
+def write_bootstrap_to_csv(data, facets_cols, sdq_subscales, n_resamples, n_workers):
+    coefs = bootstrap_ols(data, facets_cols, sdq_subscales, n_resamples=n_resamples, n_workers=n_workers)
+    for subscale, subscale_coefs in coefs.groupby("Subscale", sort=False):
+        subscale_coefs.drop("Subscale", axis=1).to_csv(f"output/paper/ols/{subscale}_bootstrap.csv", index=False)
+
+@stage("regularized")
+def write_regularized_to_csv(data, facets_cols, sdq_subscales, kind, l1_ratio, n_folds, n_workers):
+    # Alpha of every subscale chosen by cross-validation, see regularized.py
+    if kind != "elasticnet" or l1_ratio is None:
+        l1_ratio = PENALTIES[kind]
+    coefs, fit, cv = fit_regularized(
+        data, facets_cols, sdq_subscales, l1_ratio=l1_ratio, n_folds=n_folds, n_workers=n_workers)
+    logger.info("%s", fit)
+    coefs.to_csv(f"output/paper/ols/{kind}_coefs.csv", index=False)
+    fit.to_csv(f"output/paper/ols/{kind}_fit.csv", index=False)
+    cv.to_csv(f"output/paper/ols/{kind}_cv.csv", index=False)
 
 
 if __name__ == "__main__":    
 
-    data = pd.read_csv("data/merged_split_by_anchor.csv")
-    
-    facets_cols = [col for col in data.columns if "_" in col]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bootstrap", type=int, default=0, help="Number of bootstrap resamples of the coefficients")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes computing the resamples and folds")
+    parser.add_argument("--regularized", choices=PENALTIES, help="Also fit ridge, lasso or elastic net models with cross-validated alphas")
+    parser.add_argument("--l1-ratio", type=float, help="Share of the L1 penalty of --regularized elasticnet (0.5 by default)")
+    parser.add_argument("--folds", type=int, default=5, help="Number of cross-validation folds")
+    args = parser.parse_args()
+    configure_logging()
+
+    facets_cols = [col for col in intermediate_columns("merged_split_by_anchor") if "_" in col]
     sdq_subscales = ["emotion", "conduct", "hyper", "peer",	"prosoc", "tot"]
 
+    data = read_intermediate("merged_split_by_anchor", columns=facets_cols+sdq_subscales)
+
     ols_results = run_ols(data, facets_cols, sdq_subscales)
     write_results_to_csv(ols_results)
+    if args.bootstrap:
+        write_bootstrap_to_csv(data, facets_cols, sdq_subscales, args.bootstrap, args.workers)
+    if args.regularized:
+        write_regularized_to_csv(
+            data, facets_cols, sdq_subscales, args.regularized, args.l1_ratio, args.folds, args.workers)
 
         
 
@@ -1,9 +1,20 @@
 import pandas as pd
-import pingouin as pg
+import numpy as np
 import matplotlib.pyplot as plt
-import itertools
+import argparse
+import logging
 from pathlib import Path
 
+from intermediates import read_intermediate
+from agreement import agreement_table
+from icc import ICC_TYPES, icc, icc_table, tensor_from_codes
+from parallel import SharedPool, get_shared
+from rater_overlap import RaterSubjectIndex
+from resampling import bootstrap_icc
+from instrumentation import configure_logging, stage
+
+logger = logging.getLogger(__name__)
+
 def filter_doubly_rated(df):
     # Filter participants rated by two clinicians
     df_check = df[["Study ID", "Respondent Hash"]]
@@ -21,125 +32,124 @@ def get_rater_with_most_n(df):
     respondent_counts = df.groupby("Respondent Hash").count()
     most_n = respondent_counts["Study ID"].max()
     rater_with_most_n = respondent_counts[respondent_counts["Study ID"] == most_n].index[0]
-    print(rater_with_most_n)
+    logger.debug("Rater with most participants: %s", rater_with_most_n)
     return rater_with_most_n
 
 def filter_by_rater(df, raters):
     return df[(df["Respondent Hash"] == raters[0]) | (df["Respondent Hash"] == raters[1])]
 
+def make_icc_df(facets_cols, icc, pval, ci_low, ci_high):
+    icc_df = pd.DataFrame({"Item": facets_cols, "ICC": icc, "PVal": pval})
+    icc_df["CI95"] = list(np.round(np.column_stack([ci_low, ci_high]), 2))
+    return icc_df.sort_values("PVal")
+
 def check_irr_icc(df, facets_cols, raters_col, type):
-    rows = []
-    for col in facets_cols:
-        icc = pg.intraclass_corr(
-            data=df, 
-            targets="Study ID", 
-            raters=raters_col, 
-            ratings=col).set_index('Type').loc[type][["ICC", "pval", "CI95%"]]
-        rows.append([col, icc["ICC"], icc["pval"], icc["CI95%"]])
-    icc_df = pd.DataFrame(rows, columns = ["Item", "ICC", "PVal", "CI95"]).sort_values("PVal")
+    # ICCs of all items are computed at once
+    icc_df = icc_table(df, facets_cols, targets="Study ID", raters=raters_col)
+    icc_df = icc_df[icc_df["Type"] == type]
+    icc_df = make_icc_df(
+        facets_cols, 
+        icc_df["ICC"].to_numpy(), 
+        icc_df["PVal"].to_numpy(), 
+        icc_df["CI low"].to_numpy(), 
+        icc_df["CI high"].to_numpy())
     #icc_df.to_csv(f"output/paper/irr_{filename_suffix}.csv", float_format='%.3f')
     return icc_df
 
-def prepare_dfs_per_clinic(df):
-    dfs = []
-
-    clinicians = list(df["Respondent Hash"].unique())
-    
-    # Get all sets patients rated by the same 2 clinicians (=1 clinic)
-    clinician_sets = list(itertools.combinations(clinicians, 2))
-
-    for clinician_set in clinician_sets:
-        sets_of_participants = []
-        for clinician in clinician_set:
-            participants_per_clinician = set(df[df["Respondent Hash"] == clinician]["Subject ID"].unique())
-            sets_of_participants.append(participants_per_clinician)
-        overlapping_participants = set.intersection(*sets_of_participants)
-        if len(overlapping_participants) > 5:
-            clinic_df = df[(df["Respondent Hash"].isin(clinician_set) & (df["Subject ID"].isin(overlapping_participants)))]
-            dfs.append(clinic_df)
-    
-    return dfs
-
-def check_icc_per_clinic(df, facets_cols):
-    clinic_dfs = prepare_dfs_per_clinic(df)
-    save_path = "output/paper/reliability/icc_per_clinic/"
-    Path(save_path).mkdir(parents=True, exist_ok=True)
-
-    for i, clinic_df in enumerate(clinic_dfs):
-        icc_df = check_irr_icc_fixed_raters(clinic_df, facets_cols, "Respondent Hash")
-        n = len(clinic_df["Subject ID"].unique())
-        icc_df.to_csv(save_path+str(i)+"_"+str(n)+".csv", float_format='%.3f')
-
-def prepare_df_across_clinics(df, facets_cols):
+def prepare_clinic_rows(df):
+    # Get all sets patients rated by the same 2 clinicians (=1 clinic), as row positions
+    index = RaterSubjectIndex(df, raters="Respondent Hash", subjects="Subject ID")
+    clinician_pairs = index.pairs(min_overlap=6)
+
+    return [
+        index.rows_of_pair(rater_a, rater_b) 
+        for rater_a, rater_b in zip(clinician_pairs["Rater A"], clinician_pairs["Rater B"])
+    ]
+
+def renumber(codes):
+    # Consecutive codes for the values present, -1 (missing) is kept
+    renumbered = np.full(len(codes), -1)
+    labelled = codes >= 0
+    renumbered[labelled] = np.unique(codes[labelled], return_inverse=True)[1]
+    return renumbered
+
+def icc_block(rows, start, stop, raters_col, type):
+    # Runs in a worker, ratings and ID codes are shared arrays
+    ratings = get_shared("ratings")[:, start:stop]
+    targets = get_shared("Study ID")
+    raters = get_shared(raters_col)
+    if rows is not None:
+        ratings, targets, raters = ratings[rows], targets[rows], raters[rows]
+
+    result = icc(tensor_from_codes(renumber(targets), renumber(raters), ratings))
+    i = ICC_TYPES.index(type)
+    return result["ICC"][i], result["pval"][i], result["ci_low"][i], result["ci_high"][i]
+
+def submit_icc(pool, rows, n_items, raters_col, type, block_size):
+    return [
+        pool.submit(icc_block, rows, start, min(start+block_size, n_items), raters_col, type)
+        for start in range(0, n_items, block_size)
+    ]
+
+def gather_icc(futures, facets_cols):
+    # Item blocks are put together in the order they were submitted
+    blocks = [future.result() for future in futures]
+    return make_icc_df(facets_cols, *[np.concatenate(arrays) for arrays in zip(*blocks)])
+
+@stage("reliability")
+def check_reliability(df, facets_cols, n_workers=1, block_size=10):
+    '''ICC per clinic, ICC across clinics and percentage agreement. ICCs of all
+    clinics and blocks of block_size items run in n_workers processes, which get
+    the ratings through shared memory. Percentage agreement is computed meanwhile.'''
+    clinic_rows = prepare_clinic_rows(df)
     df = add_rater_count_col(df)
-    print(df.sort_values("Subject ID"))
-    return df
 
-def check_icc_across_clinics(df, facets_cols):
-    df = prepare_df_across_clinics(df, facets_cols)
-    icc_df = check_irr_icc_random_raters(df, facets_cols, raters_col="N Rater")
-    
-    icc_df.to_csv("output/paper/reliability/icc_across_clinics.csv", float_format='%.3f')
-    
-def check_irr_icc_fixed_raters(df, facets_cols, raters_col):
-    return check_irr_icc(df, facets_cols, raters_col, "ICC2")
+    arrays = {
+        "ratings": df[facets_cols].to_numpy(dtype=float),
+        "Study ID": pd.factorize(df["Study ID"])[0],
+        "Respondent Hash": pd.factorize(df["Respondent Hash"])[0],
+        "N Rater": pd.factorize(df["N Rater"])[0]
+    }
+    n_items = len(facets_cols)
 
-def check_irr_icc_random_raters(df, facets_cols, raters_col):
-    return check_irr_icc(df, facets_cols, raters_col, "ICC1")
+    with SharedPool(arrays, n_workers=n_workers) as pool:
+        per_clinic = [
+            submit_icc(pool, rows, n_items, "Respondent Hash", "ICC2", block_size) 
+            for rows in clinic_rows
+        ]
+        across_clinics = submit_icc(pool, None, n_items, "N Rater", "ICC1", block_size)
 
-def bin(df, facets_cols, n_bins):
-    # Bin FACETS cols into n_bins equally sized bins
+        check_percentage_agreement(df, facets_cols, n_bins=5)
 
-    labels = range(0, n_bins)
+        save_path = "output/paper/reliability/icc_per_clinic/"
+        Path(save_path).mkdir(parents=True, exist_ok=True)
+        for i, (rows, futures) in enumerate(zip(clinic_rows, per_clinic)):
+            n = df["Subject ID"].iloc[rows].nunique()
+            gather_icc(futures, facets_cols).to_csv(save_path+str(i)+"_"+str(n)+".csv", float_format='%.3f')
 
-    for col in facets_cols:
-        new_name = col+"_binned"
-        df[new_name] = pd.cut(df[col], bins=n_bins, labels=labels)
+        gather_icc(across_clinics, facets_cols).to_csv(
+            "output/paper/reliability/icc_across_clinics.csv", float_format='%.3f')
 
     return df
 
+@stage("reliability_bootstrap")
+def check_icc_across_clinics_bootstrap(df, facets_cols, n_resamples, n_workers=1):
+    # Bootstrap intervals of ICC1 across clinics, df has the "N Rater" column
+    icc_df = bootstrap_icc(
+        df, facets_cols, targets="Study ID", raters="N Rater", type="ICC1", 
+        n_resamples=n_resamples, n_workers=n_workers)
+    icc_df.to_csv("output/paper/reliability/icc_across_clinics_bootstrap.csv", float_format='%.3f', index=False)
+
 def add_rater_count_col(df):
     # Create a new column that counts raters per subject
     df["N Rater"] = df.groupby("Subject ID").cumcount()+1
 
     return df
 
-def transform_for_percent_agreement(df, facets_cols, n_bins):
-    # Bin into n bins
-    binned = bin(df, facets_cols, n_bins) # Split FACETS responses into n bins
-    
-    return binned
-
-def check_percentage_agreement(df, facets_cols):
-    # Check absolute agreement
-
-    rows = []
-
-    for col in facets_cols:
-        
-        col_name = col+"_binned"
-        
-        # Check if two values for the subject are equal (1 unique value)
-        agreement = df.groupby("Subject ID")[col_name].nunique().eq(1)
-        agreement_percentage = agreement.sum()/len(agreement)
-        
-        # Calculate delta between respondes, non-binned values
-        df[col] = pd.to_numeric(df[col], errors='coerce') # Is a cetegory now
-        deltas = abs(df.groupby("Subject ID")[col].diff()) # Difference with previous row
-        mean_delta = deltas.mean()
-
-        # DEBUG
-        if col == "other-special-issues_perception-of-reality":
-            print(list(deltas))
-
-        
-        rows.append([col, agreement_percentage, mean_delta])
-
-    result_df = pd.DataFrame(rows, columns=[
-        "Item", 
-        "Agreement Percentage", 
-        "Mean difference (Score 0 to 1)"
-    ])
+def check_percentage_agreement(df, facets_cols, n_bins=5):
+    # Check absolute agreement of binned responses, delta between responses, kappa and alpha, all items at once
+    result_df = agreement_table(df, facets_cols, subjects="Subject ID", n_bins=n_bins)
+
     result_df.sort_values("Agreement Percentage", ascending=False).to_csv(
         "output/paper/reliability/agreement_percentage.csv",
         float_format='%.3f')
@@ -149,7 +159,7 @@ def check_percentage_agreement(df, facets_cols):
 def transform_to_plot_agreeement(df, facets_cols):
     # Make dfs for several students, rows are items, 2 columns - 1 per rater
     students = df["Subject ID"].unique()[:3]
-    print("Students plotted: ", students)
+    logger.info("Students plotted: %s", list(students))
 
     dfs = []
 
@@ -208,20 +218,32 @@ def plot_agreement(df, facets_cols):
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", 
+        type=int, 
+        default=1, 
+        help="Number of processes computing ICCs of clinics and item blocks")
+    parser.add_argument(
+        "--bootstrap", 
+        type=int, 
+        default=0, 
+        help="Number of bootstrap resamples of the ICCs across clinics")
+    args = parser.parse_args()
+    configure_logging()
+
     save_path = "output/paper/reliability/"
     Path(save_path).mkdir(parents=True, exist_ok=True)
 
-    df = pd.read_csv("data/facets_transformed.csv", index_col=0)
+    df = read_intermediate("facets_transformed")
     facets_cols = [x for x in df.columns if x not in [
         "Entry ID", "Actor type", "Subject ID", "Study ID", "Group ID", "Time", "Respondent Hash"
     ]]
 
     df = filter_doubly_rated(df)
     
-    check_icc_per_clinic(df, facets_cols)
-    check_icc_across_clinics(df, facets_cols)
-
-    df_for_percent_agreement = bin(df, facets_cols, 5)
-    check_percentage_agreement(df_for_percent_agreement, facets_cols)
+    df = check_reliability(df, facets_cols, n_workers=args.workers)
+    if args.bootstrap:
+        check_icc_across_clinics_bootstrap(df, facets_cols, args.bootstrap, n_workers=args.workers)
 
     plot_agreement(df, facets_cols)
\ No newline at end of file
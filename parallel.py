@@ -0,0 +1,86 @@
+import numpy as np
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# Arrays available to tasks, set once per worker process
+_shared_arrays = {}
+
+def get_shared(name):
+    '''Array shared with the pool, to be called inside tasks'''
+    return _shared_arrays[name]
+
+def _attach(specs):
+    for name, (shm_name, shape, dtype) in specs.items():
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name, track=False)
+        except TypeError:
+            # Python < 3.13, workers share the resource tracker of the parent, which unlinks it
+            shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # Keep the mapping open as long as the worker lives
+        _shared_arrays[name+".shm"] = shm
+
+class SharedPool():
+    '''Process pool whose workers get numpy arrays through shared memory.
+    Arrays are copied into shared memory once, workers map them when they start,
+    so tasks only carry small arguments (row indices, item ranges) instead of
+    pickled DataFrames. With n_workers=1 tasks run in this process.
+
+    with SharedPool({"ratings": ratings}, n_workers=4) as pool:
+        futures = [pool.submit(task, rows) for rows in row_blocks]
+        results = [future.result() for future in futures]
+    '''
+
+    def __init__(self, arrays, n_workers=None):
+        self.arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        self.n_workers = n_workers or os.cpu_count()
+        self.executor = None
+        self.memory = []
+
+    def __enter__(self):
+        if self.n_workers == 1:
+            self.previous = dict(_shared_arrays)
+            _shared_arrays.update(self.arrays)
+            return self
+
+        specs = {}
+        for name, array in self.arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            self.memory.append(shm)
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            initializer=_attach,
+            initargs=(specs,))
+        return self
+
+    def submit(self, func, *args):
+        if self.executor is not None:
+            return self.executor.submit(func, *args)
+
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, func, tasks):
+        '''Runs func(*task) for every task, results are in task order'''
+        futures = [self.submit(func, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def __exit__(self, *exc):
+        if self.executor is None:
+            _shared_arrays.clear()
+            _shared_arrays.update(self.previous)
+            return False
+
+        self.executor.shutdown()
+        for shm in self.memory:
+            shm.close()
+            shm.unlink()
+        return False
@@ -0,0 +1,267 @@
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from intermediates import DATA_DIR, FORMATS
+from instrumentation import METRICS_ENV, TRACE_ENV, configure_logging
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = "data/cache/pipeline_state.json"
+LOG_DIR = "data/cache/logs/"
+# Stage records of every step, see instrumentation.py
+METRICS_DIR = "data/cache/metrics/"
+
+FACETS_PATH = "data/facets.json"
+RAW_INPUTS = [
+    "data/sdq.csv",
+    "data/diagnostics.csv",
+    "data/id_mapping_facets.csv",
+    "facets_item_translation.csv"
+]
+
+class Step():
+    '''One script of the workflow, run as python -m module args from the working directory.
+    inputs and outputs are paths relative to the working directory.'''
+
+    def __init__(self, name, module, inputs, outputs, args=None):
+        self.name = name
+        self.module = module
+        self.inputs = inputs
+        self.outputs = outputs
+        self.args = args or []
+
+def make_steps(format="csv", incremental=False, workers=1, facets=FACETS_PATH):
+    '''The workflow, intermediates are in the file format of format.
+    facets is the FACETS export or a glob pattern of several exports.'''
+    intermediate = lambda name: f"{DATA_DIR}{name}.{format}"
+    return [
+        Step(
+            "preprocessing", "data_preprocessing",
+            inputs=(sorted(glob.glob(facets)) or [facets]) + RAW_INPUTS,
+            outputs=[intermediate(name) for name in [
+                "facets_transformed", "sdq_scored_cleaned", "diagnostics_transformed",
+                "merged", "merged_split_by_anchor"]],
+            args=["--format", format, "--facets", facets, "--workers", str(workers)] + (["--incremental"] if incremental else [])),
+        Step(
+            "verification", "data_verification",
+            inputs=[intermediate("facets_transformed")],
+            outputs=[]),
+        Step(
+            "exploration", "data_exploration",
+            inputs=[intermediate("merged"), intermediate("merged_split_by_anchor")],
+            outputs=["output/description.csv", "output/group_comparisons.csv", "plots/diags/index.html"],
+            args=["--workers", str(workers)]),
+        Step(
+            "reliability", "paper_analysis.reliability",
+            inputs=[intermediate("facets_transformed")],
+            outputs=[
+                "output/paper/reliability/icc_across_clinics.csv",
+                "output/paper/reliability/agreement_percentage.csv"],
+            args=["--workers", str(workers)]),
+        Step(
+            "longitudinal", "longitudinal",
+            inputs=[intermediate("facets_transformed")],
+            outputs=["output/longitudinal/change_scores.csv", "output/longitudinal/slopes.csv"]),
+        Step(
+            "mult_reg", "paper_analysis.mult_reg",
+            inputs=[intermediate("merged_split_by_anchor")],
+            outputs=["output/paper/ols/fit.csv"]),
+    ]
+
+def module_path(module):
+    path = os.path.join(REPO_DIR, *module.split(".")) + ".py"
+    return path if os.path.exists(path) else None
+
+def code_files(module):
+    '''Source files of module and of all modules of this repo it imports, recursively'''
+    files = set()
+    modules = [module]
+    while modules:
+        path = module_path(modules.pop())
+        if path is None or path in files:
+            continue
+        files.add(path)
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules.append(node.module)
+    return sorted(files)
+
+class Pipeline():
+    '''Runs steps in dependency order (a step depends on the steps writing its inputs).
+    A step is skipped when the hash of its inputs, code (its module and the repo modules
+    it imports) and arguments matches the last successful run and its outputs are unchanged.
+    File hashes are cached by size and modification time, so unchanged large inputs
+    (the FACETS export) are not read again. Independent steps run concurrently.'''
+
+    def __init__(self, steps, state_path=STATE_PATH):
+        self.steps = {step.name: step for step in steps}
+        self.state_path = state_path
+        self.state = {"steps": {}, "files": {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+        producers = {output: step.name for step in steps for output in step.outputs}
+        self.dependencies = {
+            step.name: sorted({producers[path] for path in step.inputs if path in producers} - {step.name})
+            for step in steps
+        }
+
+    def file_hash(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cached = self.state["files"].get(path)
+        if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        self.state["files"][path] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def step_key(self, step):
+        # Content hash of everything the outputs depend on
+        sha = hashlib.sha256()
+        content = {
+            "inputs": {path: self.file_hash(path) for path in step.inputs},
+            "code": {os.path.relpath(path, REPO_DIR): self.file_hash(path) for path in code_files(step.module)},
+            "args": step.args
+        }
+        sha.update(json.dumps(content, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def is_up_to_date(self, step, key):
+        previous = self.state["steps"].get(step.name)
+        if previous is None or previous["key"] != key:
+            return False
+        return all(self.file_hash(path) == previous["outputs"].get(path) for path in step.outputs)
+
+    def selected(self, targets):
+        # Targets and all steps they depend on
+        selected = set()
+        names = list(targets or self.steps)
+        while names:
+            name = names.pop()
+            if name not in selected:
+                selected.add(name)
+                names.extend(self.dependencies[name])
+        return selected
+
+    def run_step(self, step):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + [p for p in [env.get("PYTHONPATH")] if p])
+        env.setdefault("MPLBACKEND", "Agg")
+        env[METRICS_ENV] = f"{METRICS_DIR}{step.name}.jsonl"
+        env[TRACE_ENV] = f"{METRICS_DIR}{step.name}.trace.json"
+        if os.path.exists(env[METRICS_ENV]):
+            os.remove(env[METRICS_ENV])
+
+        start = time.time()
+        with open(f"{LOG_DIR}{step.name}.log", "w") as log:
+            process = subprocess.run(
+                [sys.executable, "-m", step.module] + step.args,
+                stdout=log, stderr=subprocess.STDOUT, env=env)
+        return process.returncode, time.time() - start
+
+    def run(self, targets=None, force=False, jobs=1, dry_run=False):
+        '''Runs the targets (all steps by default) and the steps they depend on.
+        Returns the names of the steps that failed or could not run.'''
+        pending = self.selected(targets)
+        done = set()
+        failed = set()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                # Steps depending on a failed step can't run
+                for name in sorted(pending):
+                    if any(dependency in failed for dependency in self.dependencies[name]):
+                        logger.warning("%s: skipped, depends on a failed step", name)
+                        pending.discard(name)
+                        failed.add(name)
+
+                ready = [name for name in sorted(pending) if all(d in done for d in self.dependencies[name])]
+                for name in ready:
+                    pending.discard(name)
+                    step = self.steps[name]
+                    key = self.step_key(step)
+                    if not force and self.is_up_to_date(step, key):
+                        logger.info("%s: up to date", name)
+                        done.add(name)
+                        continue
+                    if dry_run:
+                        logger.info("%s: would run python -m %s %s", name, step.module, " ".join(step.args))
+                        done.add(name)
+                        continue
+                    logger.info("%s: running", name)
+                    running[executor.submit(self.run_step, step)] = (name, key)
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, key = running.pop(future)
+                    returncode, seconds = future.result()
+                    if returncode == 0:
+                        step = self.steps[name]
+                        self.state["steps"][name] = {
+                            "key": key,
+                            "outputs": {path: self.file_hash(path) for path in step.outputs}
+                        }
+                        logger.info("%s: done in %.1fs, stage metrics in %s%s.jsonl", name, seconds, METRICS_DIR, name)
+                        done.add(name)
+                    else:
+                        logger.error("%s: failed (exit code %d), see %s%s.log", name, returncode, LOG_DIR, name)
+                        failed.add(name)
+                self.save()
+
+        self.save()
+        return failed
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Runs the steps of the analysis that are out of date")
+    parser.add_argument("steps", nargs="*", help="Steps to run with the steps they depend on, all by default")
+    parser.add_argument("--force", action="store_true", help="Run steps even when they are up to date")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of steps running at the same time")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes per analysis step")
+    parser.add_argument("--format", choices=FORMATS, default="csv", help="File format of the intermediates")
+    parser.add_argument("--incremental", action="store_true", help="Preprocess only new or changed rows")
+    parser.add_argument("--facets", default=FACETS_PATH, help="FACETS export or glob pattern of several exports")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the steps that would run")
+    args = parser.parse_args()
+    configure_logging()
+
+    pipeline = Pipeline(make_steps(
+        format=args.format, incremental=args.incremental, workers=args.workers, facets=args.facets))
+    unknown = set(args.steps) - set(pipeline.steps)
+    if unknown:
+        parser.error(f"Unknown steps {', '.join(sorted(unknown))}, steps are {', '.join(pipeline.steps)}")
+
+    failed = pipeline.run(args.steps, force=args.force, jobs=args.jobs, dry_run=args.dry_run)
+    sys.exit(1 if failed else 0)
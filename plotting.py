@@ -0,0 +1,165 @@
+import numpy as np
+import html
+import os
+from matplotlib.figure import Figure
+
+from parallel import SharedPool, get_shared
+
+# Figures are made with matplotlib.figure.Figure, which draws with Agg and is not
+# registered with pyplot, so nothing is kept open after saving. One figure per
+# size is reused by all panels a process renders.
+_figures = {}
+
+def _figure(figsize):
+    figure = _figures.get(figsize)
+    if figure is None:
+        figure = _figures[figsize] = Figure(figsize=figsize)
+    figure.clear()
+    return figure
+
+def _finite(*columns):
+    keep = np.all([~np.isnan(column) for column in columns], axis=0)
+    return [column[keep] for column in columns]
+
+def scatter_panel(ax, x, y, xlabel, ylabel, dense_threshold=None, bins=50):
+    # Above dense_threshold points, a 2D histogram is drawn instead, one image instead of a marker per point
+    x, y = _finite(x, y)
+    if dense_threshold is not None and len(x) > dense_threshold:
+        ax.hist2d(x, y, bins=bins, range=[[0, 1], [np.min(y, initial=0), np.max(y, initial=1)]], cmin=1, rasterized=True)
+    else:
+        ax.scatter(x, y, s=8)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_xlim([0, 1.0])
+
+def histogram_panel(ax, x, xlabel):
+    x, = _finite(x)
+    ax.hist(x)
+    ax.set_xlabel(xlabel)
+    ax.set_xlim([0, 1])
+
+    if len(x):
+        mean = np.mean(x)
+        std_dev = np.std(x)
+        ax.axvline(mean, color='b', linestyle='--', label='Mean')
+        ax.axvline(np.median(x), color='b', linestyle='-', label='Median')
+        ax.axvline(mean - std_dev, color='y', linestyle='--', label='-1 SD')
+        ax.axvline(mean + std_dev, color='y', linestyle='--', label='+1 SD')
+        ax.axvline(mean - 2*std_dev, color='y', linestyle='--', label='-2 SD')
+        ax.axvline(mean + 2*std_dev, color='y', linestyle='--', label='+2 SD')
+        ax.legend(loc='upper right', fontsize="small")
+
+def boxplot_panel(ax, values, groups, xlabel, ylabel):
+    # One box per group value, like DataFrame.boxplot(by=...)
+    values, groups = _finite(values, groups)
+    labels = np.unique(groups)
+    ax.boxplot([values[groups == label] for label in labels])
+    ax.set_xticks(np.arange(1, len(labels)+1), [f"{label:g}" for label in labels])
+    ax.set_xlabel(xlabel)
+    ax.set_title(ylabel)
+    ax.set_ylim([0, 1])
+
+def _render_scatter(path, x_col, x_label, y_cols, y_labels, dense_threshold):
+    data = get_shared("data")
+    figure = _figure((4*len(y_cols), 4))
+    axs = figure.subplots(1, len(y_cols), squeeze=False)[0]
+    for ax, y_col, y_label in zip(axs, y_cols, y_labels):
+        scatter_panel(ax, data[:, x_col], data[:, y_col], x_label, y_label, dense_threshold=dense_threshold)
+    figure.tight_layout()
+    figure.savefig(path)
+    return path
+
+def _render_histogram(path, col, label):
+    data = get_shared("data")
+    figure = _figure((6, 4))
+    histogram_panel(figure.subplots(), data[:, col], label)
+    figure.tight_layout()
+    figure.savefig(path)
+    return path
+
+def _render_boxplots(paths, col, label, group_cols, group_labels):
+    # All group columns of one item, so the item column is read once
+    data = get_shared("data")
+    for path, group_col, group_label in zip(paths, group_cols, group_labels):
+        figure = _figure((6, 4))
+        boxplot_panel(figure.subplots(), data[:, col], data[:, group_col], group_label, label)
+        figure.tight_layout()
+        figure.savefig(path)
+    return paths
+
+def _render(data, columns, render, tasks, n_workers):
+    # data columns go to shared memory as one float matrix, tasks refer to them by position
+    arrays = {"data": data[columns].to_numpy(dtype=float)}
+    with SharedPool(arrays, n_workers=n_workers) as pool:
+        return pool.map(render, tasks)
+
+def _file_name(*names):
+    return "_".join(names).replace("/", "-") + ".png"
+
+def plot_scatters(data, x_cols, y_cols, out_dir, n_workers=1, dense_threshold=2000):
+    '''One figure per x column (e.g. FACETS item) with a scatter panel per y column
+    (e.g. SDQ subscale). Returns the file paths.'''
+    os.makedirs(out_dir, exist_ok=True)
+    columns = list(dict.fromkeys(x_cols + y_cols))
+    position = {col: i for i, col in enumerate(columns)}
+    y_positions = [position[col] for col in y_cols]
+
+    tasks = [
+        (os.path.join(out_dir, _file_name("scatter", x_col)), position[x_col], x_col,
+         y_positions, y_cols, dense_threshold)
+        for x_col in x_cols
+    ]
+    return _render(data, columns, _render_scatter, tasks, n_workers)
+
+def plot_histograms(data, cols, out_dir, n_workers=1):
+    '''One histogram with mean, median and SD lines per column. Returns the file paths.'''
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [
+        (os.path.join(out_dir, _file_name("histogram", col)), i, col)
+        for i, col in enumerate(cols)
+    ]
+    return _render(data, cols, _render_histogram, tasks, n_workers)
+
+def plot_boxplot_pairs(data, pairs, out_dir, n_workers=1):
+    '''Boxplots of a column by a group column for every (group column, column) pair,
+    named {group}_{col}.png. Pairs of the same column are rendered by one task.
+    Returns the file paths in the order of pairs.'''
+    os.makedirs(out_dir, exist_ok=True)
+    group_cols = list(dict.fromkeys(group_col for group_col, _ in pairs))
+    cols = list(dict.fromkeys(col for _, col in pairs))
+    columns = group_cols + cols
+    group_position = {group_col: i for i, group_col in enumerate(group_cols)}
+
+    tasks = []
+    for i, col in enumerate(cols):
+        col_groups = [group_col for group_col, pair_col in pairs if pair_col == col]
+        tasks.append((
+            [os.path.join(out_dir, _file_name(group_col, col)) for group_col in col_groups],
+            len(group_cols) + i, col, [group_position[group_col] for group_col in col_groups], col_groups))
+
+    if tasks:
+        _render(data, columns, _render_boxplots, tasks, n_workers)
+    return [os.path.join(out_dir, _file_name(group_col, col)) for group_col, col in pairs]
+
+def plot_boxplots(data, cols, group_cols, out_dir, n_workers=1):
+    '''Boxplots of every column (e.g. FACETS item) by every group column (e.g. diagnosis),
+    one file per group column and column named {group}_{col}.png. Returns the file paths.'''
+    return plot_boxplot_pairs(
+        data, [(group_col, col) for col in cols for group_col in group_cols], out_dir, n_workers=n_workers)
+
+def write_index(out_dir, sections, title="Plots"):
+    '''index.html in out_dir showing the plots of every section, sections is a dict
+    of section title to file paths'''
+    lines = [f"<html><head><meta charset='utf-8'><title>{html.escape(title)}</title></head><body>",
+             f"<h1>{html.escape(title)}</h1>"]
+    for section, paths in sections.items():
+        lines.append(f"<h2>{html.escape(section)}</h2>")
+        for path in paths:
+            src = html.escape(os.path.relpath(path, out_dir))
+            lines.append(f"<a href='{src}'><img src='{src}' loading='lazy' style='max-width:600px'></a>")
+    lines.append("</body></html>")
+
+    path = os.path.join(out_dir, "index.html")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+    return path
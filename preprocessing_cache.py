@@ -0,0 +1,92 @@
+import pandas as pd
+import os
+
+from intermediates import read_intermediate, write_intermediate
+
+CACHE_DIR = "data/cache/"
+
+def hash_rows(df):
+    # Content hash of each row, independent of the index
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+class RowStore():
+    '''Transformed rows kept on disk between runs, keyed by the `key` column.
+    Keys are Entry IDs for FACETS and raw row content hashes for SDQ and diagnostics.
+    All processed source keys are remembered, also the ones whose rows were
+    filtered out during preprocessing, so they are not processed again.
+    params are the settings the rows were transformed with (e.g. the locale),
+    a store saved with other params is not reused. invalidated is set when
+    cached rows were dropped, their subjects are not known to have changed.'''
+
+    def __init__(self, name, key, cache_dir=CACHE_DIR, params=None):
+        self.path = os.path.join(cache_dir, name+".pkl")
+        self.key = key
+        self.params = params or {}
+        self.rows = None
+        self.processed_keys = set()
+        self.source_columns = None
+        self.invalidated = False
+
+    def load(self):
+        if os.path.exists(self.path):
+            stored = pd.read_pickle(self.path)
+            if stored.get("params", {}) != self.params:
+                self.invalidated = True
+                return self
+            self.rows = stored["rows"]
+            self.processed_keys = stored["processed_keys"]
+            self.source_columns = stored["source_columns"]
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        pd.to_pickle({
+            "rows": self.rows,
+            "processed_keys": self.processed_keys,
+            "source_columns": self.source_columns,
+            "params": self.params
+        }, self.path)
+
+    def new_keys(self, source_keys, source_columns=None):
+        '''Keys of the source that were not processed yet. If the columns of the
+        source changed, cached rows can't be reused and everything is new.'''
+        if source_columns is not None and source_columns != self.source_columns:
+            self.invalidated = self.invalidated or self.rows is not None
+            self.rows = None
+            self.processed_keys = set()
+            self.source_columns = source_columns
+        return set(source_keys) - self.processed_keys
+
+    def update(self, source_keys, new_rows):
+        '''Drops rows whose key is gone from the source and adds new_rows.
+        Returns the dropped and added rows, to find which subjects changed.'''
+        source_keys = set(source_keys)
+
+        if self.rows is None:
+            dropped = new_rows.iloc[:0]
+            self.rows = new_rows
+        else:
+            is_gone = ~self.rows[self.key].isin(source_keys)
+            dropped = self.rows[is_gone]
+            self.rows = pd.concat([self.rows[~is_gone], new_rows], ignore_index=True)
+        self.processed_keys = source_keys
+
+        return pd.concat([dropped, new_rows], ignore_index=True)
+
+def replace_rows(name, rows, key, keys_to_replace, format="csv"):
+    '''Replaces rows with key in keys_to_replace in an intermediate file
+    with rows, keeping the file sorted by key'''
+    existing = read_intermediate(name, format=format)
+    existing[key] = existing[key].astype(str)
+    keys_to_replace = set(str(x) for x in keys_to_replace)
+    existing = existing[~existing[key].isin(keys_to_replace)]
+
+    if len(existing) > 0 and list(existing.columns) != list(rows.columns):
+        raise ValueError(f"Columns of {name} changed, run without --incremental")
+
+    rows = rows.astype({key: str})
+    updated = pd.concat([existing, rows], ignore_index=True)
+    updated = updated.sort_values(key, kind="stable").reset_index(drop=True)
+    write_intermediate(updated, name, format)
+
+    return updated
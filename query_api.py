@@ -0,0 +1,237 @@
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from intermediates import DATA_DIR, intermediate_columns, intermediate_path, read_intermediate
+from instrumentation import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Entry fields listed in profiles, item values of single entries are in facets_transformed
+ENTRY_FIELDS = ["Entry ID", "Time", "Respondent Hash", "Actor type"]
+SOURCES = ["merged", "merged_split_by_anchor", "sdq_scored_cleaned", "facets_transformed"]
+
+def _json_values(values):
+    # Object array with NaN as None, so rows can be written as JSON without converting every value
+    values = np.asarray(values, dtype=object)
+    values[pd.isna(values)] = None
+    return values
+
+def _records(columns, values):
+    return [dict(zip(columns, row)) for row in values.tolist()]
+
+class Snapshot():
+    '''Indexes of one load of the data, not changed after they are built. Readers take
+    the current snapshot once and read everything from it, so a reload running at the
+    same time never mixes rows of the old and the new data.'''
+
+    def __init__(self, data_dir, stamps):
+        self.stamps = stamps
+        merged = read_intermediate("merged", data_dir=data_dir)
+        split = read_intermediate("merged_split_by_anchor", data_dir=data_dir)
+        entries = read_intermediate(
+            "facets_transformed", columns=["Study ID"] + ENTRY_FIELDS, data_dir=data_dir)
+
+        # Merged columns by source, SDQ columns are the columns of the scored SDQ data
+        sdq_cols = set(intermediate_columns("sdq_scored_cleaned", data_dir=data_dir))
+        columns = [col for col in merged.columns if col != "Study ID"]
+        sections = {
+            "sdq": [col for col in columns if col in sdq_cols],
+            "diagnostics": [col for col in columns if col.startswith("Diag.")],
+            "facets": [col for col in columns if col not in sdq_cols and not col.startswith("Diag.")],
+        }
+        split_cols = [col for col in split.columns if col.endswith(("_LEFT", "_RIGHT"))]
+
+        # Every section as one array, rows in the order of the Study ID index
+        self.study_ids = pd.Index(merged["Study ID"].astype(str))
+        self.rows = {study_id: row for row, study_id in enumerate(self.study_ids)}
+        self.sections = {
+            name: (cols, _json_values(merged[cols].to_numpy(dtype=object))) for name, cols in sections.items()
+        }
+        split_rows = pd.Index(split["Study ID"].astype(str)).get_indexer(self.study_ids)
+        split_values = split[split_cols].to_numpy(dtype=object)
+        self.sections["split_by_anchor"] = (
+            split_cols, _json_values(np.where(split_rows[:, None] >= 0, split_values[split_rows], np.nan)))
+
+        # Entries sorted by Study ID and by Respondent Hash, index -> positions of their entries
+        entries = entries.sort_values(["Study ID", "Time"], kind="stable", ignore_index=True)
+        self.entries = entries
+        self.entry_values = _json_values(entries[ENTRY_FIELDS].to_numpy(dtype=object))
+        self.entries_by_study_id = entries.groupby(entries["Study ID"].astype(str), sort=False).indices
+        self.entries_by_respondent = entries.groupby("Respondent Hash", sort=False).indices
+
+class MergedStore():
+    '''Read access to the preprocessed data of every participant, loaded once and
+    indexed by Study ID (merged and split-by-anchor rows, FACETS entries) and by
+    Respondent Hash (FACETS entries of a rater).
+    Profiles are kept in an LRU cache of cache_size participants; refresh() loads
+    the data again and clears the cache when data_preprocessing.py wrote new files.
+    Loaded data is a Snapshot, replaced as a whole, and cached profiles are keyed by
+    their snapshot. Profiles are shared between callers and must not be modified.
+
+        store = MergedStore()
+        store.profile("S000001")["sdq"]["tot"]
+        store.get_many(["S000001", "S000002"])'''
+
+    def __init__(self, data_dir=DATA_DIR, cache_size=4096):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self._cached_profile = functools.lru_cache(maxsize=cache_size)(self._profile)
+        self._cached_respondent = functools.lru_cache(maxsize=cache_size)(self._respondent)
+        self.snapshot = None
+        self.load()
+
+    def _stamps(self):
+        # Path and modification time of the files the store was loaded from
+        stamps = {}
+        for name in SOURCES:
+            path = intermediate_path(name, data_dir=self.data_dir)
+            stamps[name] = (path, os.stat(path).st_mtime_ns)
+        return stamps
+
+    def load(self):
+        snapshot = Snapshot(self.data_dir, self._stamps())
+        with self.lock:
+            self.snapshot = snapshot
+            # Profiles of older snapshots can't be looked up anymore, only their memory is freed
+            self._cached_profile.cache_clear()
+            self._cached_respondent.cache_clear()
+        logger.info("Loaded %d participants and %d FACETS entries", len(snapshot.study_ids), len(snapshot.entries))
+
+    def refresh(self):
+        '''Loads the data again if a file changed since it was loaded, returns if it did'''
+        with self.lock:
+            if self._stamps() == self.snapshot.stamps:
+                return False
+            self.load()
+            return True
+
+    def profile(self, study_id):
+        return self._cached_profile(self.snapshot, str(study_id))
+
+    def respondent(self, respondent_hash):
+        return self._cached_respondent(self.snapshot, respondent_hash)
+
+    def _profile(self, snapshot, study_id):
+        row = snapshot.rows.get(study_id)
+        if row is None:
+            return None
+        profile = {"Study ID": snapshot.study_ids[row]}
+        for name, (cols, values) in snapshot.sections.items():
+            profile[name] = _records(cols, values[row:row+1])[0]
+        positions = snapshot.entries_by_study_id.get(snapshot.study_ids[row], [])
+        profile["entries"] = _records(ENTRY_FIELDS, snapshot.entry_values[positions])
+        return profile
+
+    def get_many(self, study_ids, sections=None):
+        '''Rows of study_ids (Study ID plus the columns of sections, all by default) as one
+        frame, looked up together. Unknown Study IDs are left out.'''
+        snapshot = self.snapshot
+        sections = sections or list(snapshot.sections)
+        rows = snapshot.study_ids.get_indexer([str(study_id) for study_id in study_ids])
+        rows = rows[rows >= 0]
+        frames = [pd.DataFrame({"Study ID": snapshot.study_ids[rows]})]
+        for name in sections:
+            cols, values = snapshot.sections[name]
+            frames.append(pd.DataFrame(values[rows], columns=cols).infer_objects())
+        return pd.concat(frames, axis=1)
+
+    def profiles(self, study_ids):
+        # Profiles of study_ids, None for unknown Study IDs, all from the same snapshot
+        snapshot = self.snapshot
+        return [self._cached_profile(snapshot, str(study_id)) for study_id in study_ids]
+
+    def _respondent(self, snapshot, respondent_hash):
+        positions = snapshot.entries_by_respondent.get(respondent_hash)
+        if positions is None:
+            return None
+        entries = snapshot.entries.iloc[positions]
+        return {
+            "Respondent Hash": respondent_hash,
+            "Study IDs": sorted(entries["Study ID"].dropna().astype(str).unique()),
+            "entries": _records(["Study ID"] + ENTRY_FIELDS, _json_values(entries[["Study ID"] + ENTRY_FIELDS])),
+        }
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''JSON API over a MergedStore (server.store):
+    GET /subjects/<Study ID>, GET /subjects?ids=<Study ID>,<Study ID>,...,
+    POST /subjects with {"ids": [...]}, GET /respondents/<Respondent Hash>'''
+
+    def _send(self, status, body):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _lookup(self, parts, query):
+        store = self.server.store
+        store.refresh()
+        if parts == ["subjects"] and "ids" in query:
+            ids = [study_id for ids in query["ids"] for study_id in ids.split(",") if study_id]
+            return 200, store.profiles(ids)
+        if len(parts) == 2 and parts[0] == "subjects":
+            profile = store.profile(parts[1])
+            return (200, profile) if profile is not None else (404, {"error": f"Unknown Study ID {parts[1]}"})
+        if len(parts) == 2 and parts[0] == "respondents":
+            respondent = store.respondent(parts[1])
+            return (200, respondent) if respondent is not None else (404, {"error": f"Unknown Respondent Hash {parts[1]}"})
+        return 404, {"error": f"Unknown path {self.path}"}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/") if part]
+        self._send(*self._lookup(parts, parse_qs(url.query)))
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "subjects":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            ids = body["ids"]
+        except (ValueError, KeyError, TypeError):
+            return self._send(400, {"error": 'Expected a JSON body {"ids": [...]}'})
+        self.server.store.refresh()
+        self._send(200, self.server.store.profiles(ids))
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def serve(store, host="127.0.0.1", port=8000):
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.store = store
+    logger.info("Serving on http://%s:%d", host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Looks up participants in the preprocessed data or serves them as JSON")
+    parser.add_argument("study_ids", nargs="*", help="Study IDs to print the profile of")
+    parser.add_argument("--respondent", help="Respondent Hash to print the FACETS entries of")
+    parser.add_argument("--serve", action="store_true", help="Start the HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=4096, help="Number of profiles kept in memory")
+    args = parser.parse_args()
+    configure_logging()
+
+    store = MergedStore(cache_size=args.cache_size)
+    if args.study_ids:
+        print(json.dumps(store.profiles(args.study_ids), indent=1, default=str))
+    if args.respondent:
+        print(json.dumps(store.respondent(args.respondent), indent=1, default=str))
+    if args.serve:
+        serve(store, host=args.host, port=args.port)
@@ -0,0 +1,68 @@
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+class RaterSubjectIndex():
+    '''Sparse rater x subject incidence matrix of a long df (one row per rating).
+    Subjects shared by every pair of raters come from one sparse product,
+    instead of filtering the df for each pair of raters.
+    Raters are numbered in order of first appearance, like df[raters].unique().'''
+
+    def __init__(self, df, raters="Respondent Hash", subjects="Subject ID"):
+        rater_codes, self.raters = pd.factorize(df[raters])
+        subject_codes, self.subjects = pd.factorize(df[subjects])
+        self.rater_codes = rater_codes
+        self.subject_codes = subject_codes
+
+        labelled = (rater_codes >= 0) & (subject_codes >= 0)
+        incidence = sparse.csr_matrix(
+            (np.ones(labelled.sum()), (rater_codes[labelled], subject_codes[labelled])),
+            shape=(len(self.raters), len(self.subjects)))
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        self.incidence = incidence
+
+        # Number of shared subjects of every pair of raters
+        self.overlap = (incidence @ incidence.T).tocsr()
+
+        # Rows of the df grouped by rater, rows without rater (code -1) sort first
+        self.rows_by_rater = np.argsort(rater_codes, kind="stable")[(rater_codes < 0).sum():]
+        self.rater_offsets = np.concatenate([[0], np.cumsum(np.bincount(
+            rater_codes[rater_codes >= 0], minlength=len(self.raters)))])
+
+    def pairs(self, min_overlap=1):
+        '''Pairs of raters sharing at least min_overlap subjects, in the order
+        of itertools.combinations over the raters. Returns a df with the rater
+        codes, rater labels and the number of shared subjects.'''
+        upper = sparse.triu(self.overlap, k=1).tocoo()
+        keep = upper.data >= min_overlap
+        a, b, n = upper.row[keep], upper.col[keep], upper.data[keep].astype(int)
+        order = np.lexsort((b, a))
+        a, b, n = a[order], b[order], n[order]
+
+        return pd.DataFrame({
+            "Rater A": a,
+            "Rater B": b,
+            "Rater A Label": self.raters[a],
+            "Rater B Label": self.raters[b],
+            "N": n
+        })
+
+    def _shared_subject_codes(self, rater_a, rater_b):
+        indptr, indices = self.incidence.indptr, self.incidence.indices
+        return np.intersect1d(
+            indices[indptr[rater_a]:indptr[rater_a+1]],
+            indices[indptr[rater_b]:indptr[rater_b+1]])
+
+    def shared_subjects(self, rater_a, rater_b):
+        '''Subject labels rated by both raters (rater codes)'''
+        return self.subjects[self._shared_subject_codes(rater_a, rater_b)]
+
+    def rows_of_pair(self, rater_a, rater_b):
+        '''Positions of the df rows of both raters for their shared subjects, in df order'''
+        rows = np.concatenate([
+            self.rows_by_rater[self.rater_offsets[rater]:self.rater_offsets[rater+1]]
+            for rater in (rater_a, rater_b)
+        ])
+        shared = self._shared_subject_codes(rater_a, rater_b)
+        return np.sort(rows[np.isin(self.subject_codes[rows], shared)])
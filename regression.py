@@ -0,0 +1,94 @@
+import pandas as pd
+import numpy as np
+from scipy import stats
+
+def ols(X, Y, alpha=0.05):
+    '''Least squares fit of every column of Y (n x k) on the same design X (n x p).
+    X is factorized once (SVD, like statsmodels' pinv), all responses are solved
+    together. R2 is uncentered unless X has a constant column, as in statsmodels.
+    Returns a dict of arrays, (p x k) for coefficient statistics, (k,) for fit statistics.'''
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    n = len(X)
+
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    tol = s.max() * max(X.shape) * np.finfo(float).eps
+    rank = int((s > tol).sum())
+    U, s, Vt = U[:, :rank], s[:rank], Vt[:rank]
+
+    coefs = Vt.T @ ((U.T @ Y) / s[:, None])
+    resid = Y - X @ coefs
+    ssr = (resid**2).sum(axis=0)
+    df_resid = np.float64(n - rank)
+
+    # Diagonal of (X'X)^-1 from the SVD
+    cov_diag = ((Vt.T / s)**2).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = ssr / df_resid
+        se = np.sqrt(cov_diag[:, None] * scale[None, :])
+        t = coefs / se
+    pvals = 2 * stats.t.sf(np.abs(t), df_resid)
+    t_crit = stats.t.ppf(1 - alpha/2, df_resid)
+
+    has_constant = bool(np.any((np.ptp(X, axis=0) == 0) & (X[0] != 0)))
+    if has_constant:
+        tss = ((Y - Y.mean(axis=0))**2).sum(axis=0)
+        df_model = rank - 1
+    else:
+        tss = (Y**2).sum(axis=0)
+        df_model = rank
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rsquared = 1 - ssr/tss
+        rsquared_adj = 1 - (n - int(has_constant)) / df_resid * (1 - rsquared)
+        f = ((tss - ssr) / df_model) / scale
+    f_pvals = stats.f.sf(f, df_model, df_resid)
+
+    return {
+        "coef": coefs,
+        "se": se,
+        "t": t,
+        "pval": pvals,
+        "ci_low": coefs - t_crit*se,
+        "ci_high": coefs + t_crit*se,
+        "n": n,
+        "df_resid": df_resid,
+        "rsquared": rsquared,
+        "rsquared_adj": rsquared_adj,
+        "f": f,
+        "f_pval": f_pvals
+    }
+
+def fit_ols(data, predictors, responses, add_constant=False, alpha=0.05):
+    '''Fits all responses (e.g. SDQ subscales) on the same predictors in one factorization.
+    Rows with missing values in any predictor or response are dropped.
+    Returns a tidy coefficient table and a table of fit statistics.'''
+    data = data[predictors + responses].dropna()
+    X = data[predictors].to_numpy(dtype=float)
+    if add_constant:
+        X = np.column_stack([np.ones(len(X)), X])
+        predictors = ["const"] + predictors
+
+    result = ols(X, data[responses].to_numpy(dtype=float), alpha=alpha)
+
+    p, k = result["coef"].shape
+    coefs = pd.DataFrame({
+        "Subscale": np.repeat(responses, p),
+        "Variable": np.tile(predictors, k),
+        "Coef": result["coef"].T.ravel(),
+        "SE": result["se"].T.ravel(),
+        "t": result["t"].T.ravel(),
+        "PVal": result["pval"].T.ravel(),
+        "CI low": result["ci_low"].T.ravel(),
+        "CI high": result["ci_high"].T.ravel()
+    })
+    fit = pd.DataFrame({
+        "Subscale": responses,
+        "N": result["n"],
+        "DF resid": result["df_resid"],
+        "R2": result["rsquared"],
+        "Adj R2": result["rsquared_adj"],
+        "F": result["f"],
+        "F PVal": result["f_pval"]
+    })
+
+    return coefs, fit
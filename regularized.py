@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+
+from parallel import SharedPool, get_shared
+
+# l1_ratio of every penalty, elastic net mixes both
+PENALTIES = {"ridge": 0.0, "lasso": 1.0, "elasticnet": 0.5}
+
+def standardize(X, Y):
+    '''Centered and scaled (population SD) X and Y, with their means and scales.
+    Constant columns keep scale 1, so they are all zero and get coefficient 0.'''
+    x_mean, x_scale = X.mean(axis=0), X.std(axis=0)
+    y_mean, y_scale = Y.mean(axis=0), Y.std(axis=0)
+    x_scale[x_scale == 0] = 1
+    y_scale[y_scale == 0] = 1
+    return (X - x_mean) / x_scale, (Y - y_mean) / y_scale, x_mean, x_scale, y_mean, y_scale
+
+def alpha_grid(X, Y, l1_ratio=1.0, n_alphas=50, eps=1e-3):
+    '''Decreasing alphas, log-spaced from the smallest alpha at which all lasso
+    coefficients of every response are zero down to eps times it (on standardized data)'''
+    Xs, Ys = standardize(X, Y)[:2]
+    alpha_max = np.abs(Xs.T @ Ys).max() / (len(X) * max(l1_ratio, 1e-2))
+    return np.geomspace(alpha_max, alpha_max*eps, n_alphas)
+
+def ridge_path(X, Y, alphas):
+    '''Ridge coefficients (alphas x p x k) of every column of Y (n x k) for every alpha,
+    minimizing 1/2n ||y - Xb||^2 + alpha/2 ||b||^2. X is factorized once (SVD),
+    every alpha only rescales the singular values.'''
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    shrink = s / (s**2 + len(X)*np.asarray(alphas)[:, None])
+    return np.einsum("rp,ar,rk->apk", Vt, shrink, U.T @ Y)
+
+def enet_path(gram, xy, alphas, l1_ratio, tol=1e-5, max_iter=10000):
+    '''Elastic net coefficients (alphas x p x k) of every response for decreasing alphas,
+    minimizing 1/2n ||y - Xb||^2 + alpha*l1_ratio*|b|_1 + alpha*(1 - l1_ratio)/2 ||b||^2.
+    Accelerated proximal gradient (FISTA) on gram = X'X/n and xy = X'Y/n (p x k): every
+    iteration is one product with gram for all responses, whatever the number of rows.
+    Every alpha starts from the solution of the previous one (warm start), momentum
+    restarts when a step goes uphill, and iterations stop when no coefficient violates
+    the optimality conditions by more than tol.'''
+    p, k = xy.shape
+    lipschitz = np.linalg.eigvalsh(gram)[-1]
+    coefs = np.empty((len(alphas), p, k))
+    b = np.zeros((p, k))
+
+    for a, alpha in enumerate(alphas):
+        l1, l2 = alpha*l1_ratio, alpha*(1 - l1_ratio)
+        step = 1 / (lipschitz + l2)
+        z, t = b, 1.
+        for i in range(max_iter):
+            new = z - step*(gram @ z - xy + l2*z)
+            new = np.sign(new) * np.maximum(np.abs(new) - step*l1, 0)
+            t_new = (1 + np.sqrt(1 + 4*t*t)) / 2
+            if ((z - new) * (new - b)).sum() > 0:
+                z, t_new = new, 1.
+            else:
+                z = new + (t - 1) / t_new * (new - b)
+            b, t = new, t_new
+            if i % 10 == 0:
+                # Gradient of the smooth part is -l1*sign(b) where b != 0 and within [-l1, l1] where b = 0
+                grad = gram @ b - xy + l2*b
+                violation = np.where(b != 0, np.abs(grad + l1*np.sign(b)), np.abs(grad) - l1)
+                if violation.max() < tol:
+                    break
+        coefs[a] = b
+    return coefs
+
+def regularization_path(X, Y, alphas, l1_ratio, tol=1e-5, max_iter=10000):
+    '''Coefficients (alphas x p x k) and intercepts (alphas x k) on the scale of X and Y.
+    The penalty applies to standardized X and Y, so one alpha grid fits all responses.
+    Ridge (l1_ratio=0) is solved from the SVD, otherwise by proximal gradient on the
+    Gram matrix, computed once for all alphas and responses.'''
+    Xs, Ys, x_mean, x_scale, y_mean, y_scale = standardize(X, Y)
+    if l1_ratio == 0:
+        coefs = ridge_path(Xs, Ys, alphas)
+    else:
+        n = len(X)
+        coefs = enet_path(Xs.T @ Xs / n, Xs.T @ Ys / n, alphas, l1_ratio, tol=tol, max_iter=max_iter)
+    coefs = coefs / x_scale[None, :, None] * y_scale[None, None, :]
+    intercepts = y_mean - np.einsum("p,apk->ak", x_mean, coefs)
+    return coefs, intercepts
+
+def _cv_fold(fold, alphas, l1_ratio, tol, max_iter):
+    # Runs in a worker, held-out mean squared error (alphas x k) of the path fitted without fold
+    X, Y, folds = get_shared("X"), get_shared("Y"), get_shared("folds")
+    train, test = folds != fold, folds == fold
+    coefs, intercepts = regularization_path(X[train], Y[train], alphas, l1_ratio, tol=tol, max_iter=max_iter)
+    predictions = np.einsum("np,apk->ank", X[test], coefs) + intercepts[:, None, :]
+    return ((predictions - Y[test][None])**2).mean(axis=1)
+
+def cross_validate(X, Y, alphas, l1_ratio, n_folds=5, seed=0, n_workers=1, tol=1e-5, max_iter=10000):
+    '''k-fold cross-validated mean squared error (folds x alphas x k) of the whole path,
+    folds run in n_workers processes sharing X and Y'''
+    folds = np.random.default_rng(seed).permutation(len(X)) % n_folds
+    with SharedPool({"X": X, "Y": Y, "folds": folds}, n_workers=n_workers) as pool:
+        mse = pool.map(_cv_fold, [(fold, alphas, l1_ratio, tol, max_iter) for fold in range(n_folds)])
+    return np.stack(mse)
+
+def fit_regularized(data, predictors, responses, l1_ratio=0.5, alphas=None, n_alphas=50,
+                    n_folds=5, seed=0, n_workers=1, tol=1e-5, max_iter=10000):
+    '''Regularized fits of all responses (e.g. SDQ subscales) on the same predictors,
+    the alpha of every response is chosen by k-fold cross-validation (lowest mean
+    squared error). Rows with missing values in any predictor or response are dropped.
+    Returns a coefficient table (with the intercept as "const"), a table of fit
+    statistics and the cross-validation error of every alpha, like regression.fit_ols.'''
+    data = data[predictors + responses].dropna()
+    X = data[predictors].to_numpy(dtype=float)
+    Y = data[responses].to_numpy(dtype=float)
+    alphas = alpha_grid(X, Y, l1_ratio, n_alphas) if alphas is None else np.sort(np.asarray(alphas, dtype=float))[::-1]
+
+    mse = cross_validate(X, Y, alphas, l1_ratio, n_folds=n_folds, seed=seed, n_workers=n_workers, tol=tol, max_iter=max_iter)
+    mean_mse = mse.mean(axis=0)
+    se_mse = mse.std(axis=0, ddof=1) / np.sqrt(n_folds)
+    best = mean_mse.argmin(axis=0)
+
+    coefs, intercepts = regularization_path(X, Y, alphas, l1_ratio, tol=tol, max_iter=max_iter)
+    k = len(responses)
+    chosen = coefs[best, :, np.arange(k)]
+    chosen_intercepts = intercepts[best, np.arange(k)]
+
+    coef_table = pd.DataFrame({
+        "Subscale": np.repeat(responses, len(predictors) + 1),
+        "Variable": np.tile(["const"] + predictors, k),
+        "Coef": np.column_stack([chosen_intercepts, chosen]).ravel()
+    })
+    fit = pd.DataFrame({
+        "Subscale": responses,
+        "N": len(data),
+        "L1 ratio": l1_ratio,
+        "Alpha": alphas[best],
+        "CV MSE": mean_mse[best, np.arange(k)],
+        "CV MSE SE": se_mse[best, np.arange(k)],
+        "CV R2": 1 - mean_mse[best, np.arange(k)] / Y.var(axis=0),
+        "Nonzero": (chosen != 0).sum(axis=1)
+    })
+    cv = pd.DataFrame({
+        "Subscale": np.tile(responses, len(alphas)),
+        "Alpha": np.repeat(alphas, k),
+        "CV MSE": mean_mse.ravel(),
+        "CV MSE SE": se_mse.ravel()
+    })
+    return coef_table, fit, cv
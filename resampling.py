@@ -0,0 +1,140 @@
+import pandas as pd
+import numpy as np
+from functools import partial
+from scipy.stats import rankdata
+
+from correlation import corr_block, masked_corr, tidy_corr
+from icc import ICC_TYPES, icc_values, mean_squares, rating_tensor
+from parallel import SharedPool, get_shared
+from regression import fit_ols
+
+def resample_indices(n, size, kind, rng):
+    '''(size x n) row indices, drawn with replacement for "bootstrap",
+    a shuffle of all rows per resample for "permutation"'''
+    if kind == "bootstrap":
+        return rng.integers(0, n, size=(size, n))
+    if kind == "permutation":
+        return rng.permuted(np.tile(np.arange(n), (size, 1)), axis=1)
+    raise ValueError(f"Unknown resampling {kind}")
+
+def _resample_chunk(statistic, names, kind, n, size, seed):
+    # Runs in a worker, the data are shared arrays
+    arrays = [get_shared(name) for name in names]
+    indices = resample_indices(n, size, kind, np.random.default_rng(seed))
+    return statistic(*arrays, indices)
+
+def run_resamples(statistic, arrays, n, n_resamples=1000, kind="bootstrap", seed=0, chunk_size=100, n_workers=1):
+    '''Evaluates statistic(*arrays, indices) on chunks of chunk_size resamples of n rows,
+    indices is a (chunk_size x n) matrix, so the statistic is computed for the whole chunk
+    as array operations. Chunks run in n_workers processes sharing the arrays.
+    Every chunk gets its own seed spawned from seed, so results don't depend on n_workers.
+    Returns the statistics of all resamples stacked along the first axis.'''
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    names = list(arrays)
+
+    with SharedPool(arrays, n_workers=n_workers) as pool:
+        chunks = pool.map(_resample_chunk, [
+            (statistic, names, kind, n, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)
+        ])
+    return np.concatenate(chunks)
+
+def percentile_ci(estimates, alpha=0.05):
+    # Percentile intervals over the resamples (first axis), failed resamples (NaN) are left out
+    return np.nanpercentile(estimates, [100*alpha/2, 100*(1 - alpha/2)], axis=0)
+
+def permutation_pval(observed, permuted):
+    # Two-sided, the observed statistic counts as one of the permutations
+    extreme = (np.abs(permuted) >= np.abs(observed)).sum(axis=0)
+    return (1 + extreme) / (1 + len(permuted))
+
+def icc_statistic(tensor, indices, type="ICC2"):
+    # Targets are resampled, (resamples x items)
+    return icc_values(mean_squares(tensor[indices]))[:, ICC_TYPES.index(type)]
+
+def corr_statistic(X, Y, indices, method="pearson"):
+    # Rows are resampled, (resamples x X cols x Y cols)
+    X, Y = X[indices], Y[indices]
+    if method == "spearman":
+        X = rankdata(X, axis=-2, nan_policy="omit")
+        Y = rankdata(Y, axis=-2, nan_policy="omit")
+    return masked_corr(X, Y)[0]
+
+def corr_permutation_statistic(X, Y, indices):
+    # Rows of Y are shuffled against X, (resamples x X cols x Y cols)
+    return masked_corr(X[None], Y[indices])[0]
+
+def ols_statistic(X, Y, indices):
+    # Rows are resampled, one stacked pseudo-inverse for all resamples, (resamples x predictors x responses)
+    return np.linalg.pinv(X[indices]) @ Y[indices]
+
+def bootstrap_icc(df, items, targets="Study ID", raters="Respondent Hash", type="ICC2",
+                  n_resamples=1000, alpha=0.05, seed=0, chunk_size=100, n_workers=1):
+    '''Bootstrap (over targets) standard errors and percentile intervals of one ICC type, all items at once'''
+    tensor, _, _ = rating_tensor(df, targets, raters, items)
+    observed = icc_statistic(tensor, np.arange(len(tensor))[None], type=type)[0]
+
+    estimates = run_resamples(
+        partial(icc_statistic, type=type), {"tensor": tensor}, len(tensor),
+        n_resamples=n_resamples, seed=seed, chunk_size=chunk_size, n_workers=n_workers)
+    ci_low, ci_high = percentile_ci(estimates, alpha)
+
+    return pd.DataFrame({
+        "Item": items,
+        "Type": type,
+        "ICC": observed,
+        "Boot SE": np.nanstd(estimates, axis=0, ddof=1),
+        "Boot CI low": ci_low,
+        "Boot CI high": ci_high
+    })
+
+def bootstrap_corr(data, x_cols, y_cols, method="pearson", n_resamples=1000, alpha=0.05,
+                   seed=0, chunk_size=100, n_workers=1):
+    '''corr_block with bootstrap percentile intervals and permutation p-values.
+    Returns the tidy table of tidy_corr with Boot CI low, Boot CI high and Perm PVal.'''
+    corr = corr_block(data, x_cols, y_cols, method=method, alpha=alpha)
+    X = data[x_cols].to_numpy(dtype=float)
+    Y = data[y_cols].to_numpy(dtype=float)
+    arrays = {"X": X, "Y": Y}
+
+    estimates = run_resamples(
+        partial(corr_statistic, method=method), arrays, len(data),
+        n_resamples=n_resamples, seed=seed, chunk_size=chunk_size, n_workers=n_workers)
+    ci_low, ci_high = percentile_ci(estimates, alpha)
+
+    # Ranks don't change when rows are shuffled, so columns are ranked once
+    if method == "spearman":
+        arrays = {"X": rankdata(X, axis=0, nan_policy="omit"), "Y": rankdata(Y, axis=0, nan_policy="omit")}
+    permuted = run_resamples(
+        corr_permutation_statistic, arrays, len(data), n_resamples=n_resamples, kind="permutation",
+        seed=seed+1, chunk_size=chunk_size, n_workers=n_workers)
+    pval = permutation_pval(corr["r"].to_numpy(), permuted)
+
+    frame = lambda values: pd.DataFrame(values, index=x_cols, columns=y_cols).stack().to_numpy()
+    tidy = tidy_corr(corr)
+    tidy["Boot CI low"] = frame(ci_low)
+    tidy["Boot CI high"] = frame(ci_high)
+    tidy["Perm PVal"] = frame(pval)
+    return tidy
+
+def bootstrap_ols(data, predictors, responses, add_constant=False, n_resamples=1000, alpha=0.05,
+                  seed=0, chunk_size=100, n_workers=1):
+    '''fit_ols coefficient table with bootstrap (over rows) standard errors and percentile intervals'''
+    coefs, _ = fit_ols(data, predictors, responses, add_constant=add_constant, alpha=alpha)
+
+    data = data[predictors + responses].dropna()
+    X = data[predictors].to_numpy(dtype=float)
+    if add_constant:
+        X = np.column_stack([np.ones(len(X)), X])
+    Y = data[responses].to_numpy(dtype=float)
+
+    estimates = run_resamples(
+        ols_statistic, {"X": X, "Y": Y}, len(data),
+        n_resamples=n_resamples, seed=seed, chunk_size=chunk_size, n_workers=n_workers)
+    ci_low, ci_high = percentile_ci(estimates, alpha)
+
+    # Same order as the coefficient table, by response then predictor
+    coefs["Boot SE"] = np.nanstd(estimates, axis=0, ddof=1).T.ravel()
+    coefs["Boot CI low"] = ci_low.T.ravel()
+    coefs["Boot CI high"] = ci_high.T.ravel()
+    return coefs
@@ -1,70 +1,139 @@
-import pandas as pd 
+import pandas as pd
 import numpy as np
 
+from instrumentation import stage
+
+SUBSCALES = {
+    "emotion": ["somatic", "worries", "unhappy", "clingy", "afraid"],
+    "conduct": ["tantrum", "obeys", "fights", "lies", "steals"],
+    "hyper": ["restles", "fidgety", "distrac", "reflect", "attends"],
+    "peer": ["loner", "friend", "popular", "bullied", "oldbest"],
+    "prosoc": ["consid", "shares", "caring", "kind", "helpout"]
+}
+# Items in subscale order, the item matrix is laid out like this
+ITEMS = [item for items in SUBSCALES.values() for item in items]
+INVERSE_ITEMS = ["obeys", "reflect", "attends", "friend", "popular"]
+SCORES = list(SUBSCALES) + ["tot", "extern", "intern"]
+
+# Impact supplement, "ebddiff" is the question if the child has difficulties.
+# The teacher version has no home life and leisure items.
+# Column names are prefixed by the informant (p, t or s) like the items.
+IMPACT_ITEMS = {
+    "p": ["distres", "imphome", "impfrie", "impclas", "impleis"],
+    "t": ["distres", "impfrie", "impclas"],
+    "s": ["distres", "imphome", "impfrie", "impclas", "impleis"]
+}
+# Recoded value of impact items, indexed by the response:
+# not at all, only a little = 0, quite a lot = 1, a great deal = 2
+IMPACT_RECODE = np.array([0., 0., 1., 2.])
+
+# Recoded value of inverse items, indexed by the response (0, 1, 2)
+INVERSE_RECODE = np.array([2., 1., 0.])
+# Subscales are prorated if at least 3 of 5 items are answered
+MAX_MISSING = 2
+
+def score_items(items):
+    '''Scores an (n x 25) array of SDQ responses with columns in ITEMS order.
+    All subscales are scored in one pass over the array.
+    Returns the recoded items, an (n x 8) array of scores in SCORES order
+    and an (n x 5) array of missing items per subscale.'''
+    items = np.array(items, dtype=float)
+    n = len(items)
+
+    # Recode inverse items with the lookup table, other values are kept
+    inverse_cols = [ITEMS.index(item) for item in INVERSE_ITEMS]
+    inverse = items[:, inverse_cols]
+    valid = np.isin(inverse, [0, 1, 2])
+    inverse[valid] = INVERSE_RECODE[inverse[valid].astype(int)]
+    items[:, inverse_cols] = inverse
+
+    by_subscale = items.reshape(n, len(SUBSCALES), 5)
+    missing = np.isnan(by_subscale)
+    n_missing = missing.sum(axis=2)
+    sums = np.where(missing, 0, by_subscale).sum(axis=2)
+
+    scores = np.empty((n, len(SCORES)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Mean of answered items scaled to 5 items
+        scores[:, :5] = np.round(sums / (5 - n_missing) * 5)
+    scores[:, :5][n_missing > MAX_MISSING] = np.nan
+
+    # Total difficulties, all subscales except prosocial
+    scores[:, 5] = scores[:, :4].sum(axis=1)
+
+    # Externalising (conduct + hyper) and internalising (emotion + peer)
+    scores[:, 6] = scores[:, 1] + scores[:, 2]
+    scores[:, 7] = scores[:, 0] + scores[:, 3]
+
+    return items, scores, n_missing
+
+def score_impact(difficulties, impact):
+    '''Scores the impact supplement. difficulties is the (n,) ebddiff response,
+    impact an (n x 5) array of distress and impairment responses (0 to 3),
+    unused items (teacher version) set to 0.
+    Impact is 0 if no difficulties were reported and missing if any item is.'''
+    impact = np.array(impact, dtype=float)
+    missing = np.isnan(impact)
+    valid = np.isin(impact, [0, 1, 2, 3])
+    impact[valid] = IMPACT_RECODE[impact[valid].astype(int)]
+
+    scores = impact.sum(axis=1)
+    scores[missing.any(axis=1)] = np.nan
+    scores[difficulties == 0] = 0
+    scores[np.isnan(difficulties)] = np.nan
+
+    return scores
+
 class SDQScorer():
     '''Takes a df with SDQ data, format:
     Columns: ID, consid, restles, somatic, ...
     Column names are from https://www.sdqinfo.org/c9.html
-    Impact scores are not implemeted'''
+    By default columns have no informant prefix. With informants, e.g. ["p", "t", "s"],
+    parent, teacher and self report columns (pconsid, tconsid, sconsid, ...) are scored
+    and scores get the same prefix (pemotion, temotion, ...).
+    Impact scores are added for informants that have the impact supplement columns.'''
 
-    def __init__(self, df):
+    def __init__(self, df, informants=None):
         self.df = df
+        self.informants = informants if informants is not None else [""]
+
+    def _set_columns(self, columns, values):
+        # Adds all score columns at once instead of inserting them one by one
+        scores = pd.DataFrame(values, index=self.df.index, columns=columns)
+        self.df = pd.concat([self.df.drop(columns, axis=1, errors="ignore"), scores], axis=1)
 
-    def _recode_inverse_items(self):
-        recode_dict = {0: 2, 1: 1, 2: 0}
-        
-        self.df["obeys"].replace(recode_dict, inplace=True)
-        self.df["reflect"].replace(recode_dict, inplace=True)
-        self.df["attends"].replace(recode_dict, inplace=True)
-        self.df["friend"].replace(recode_dict, inplace=True)
-        self.df["popular"].replace(recode_dict, inplace=True)
-        
-    def _score_subscale(self, cols, name):
-        df = self.df[cols]
-        df["n missing"] = df.isnull().sum(axis=1) # Calculate nan values for each row
-        df["score"] = df[cols].mean(axis=1, skipna=True) * 5
-        df["score"] = np.round(df["score"])
-        df[df["n missing"] > 3]["score"] = np.nan 
-        print(df)
-        self.df[name] = df["score"]
-
-    def _score(self):
-
-        # Score Emotion
-        emo_cols = ["somatic", "worries", "unhappy", "clingy", "afraid"]
-        emo_name = "emotion"
-        self._score_subscale(emo_cols, emo_name)
-
-        # Score Conduct
-        conduct_cols = ["tantrum", "obeys", "fights", "lies", "steals"]
-        conduct_name = "conduct"
-        self._score_subscale(conduct_cols, conduct_name)
-
-        # Score Hyper
-        hyper_cols = ["restles", "fidgety", "distrac", "reflect", "attends"]
-        hyper_name = "hyper"
-        self._score_subscale(hyper_cols, hyper_name)
-
-        # Score Peer 
-        peer_cols = ["loner", "friend", "popular", "bullied", "oldbest"]
-        peer_name = "peer"
-        self._score_subscale(peer_cols, peer_name)
-
-        # Score Prosoc
-        prosoc_cols = ["consid", "shares", "caring", "kind", "helpout"]
-        prosol_name = "prosoc"
-        self._score_subscale(prosoc_cols, prosol_name)
-
-        # Score total
-        self.df["tot"] = (
-            self.df[emo_name] + 
-            self.df[conduct_name] + 
-            self.df[hyper_name] + 
-            self.df[peer_name]
-        )
+    def _score_impact(self):
+        # Unprefixed columns follow the parent version
+        layouts = {
+            prefix: IMPACT_ITEMS[prefix or "p"] for prefix in self.informants 
+            if all(prefix+col in self.df.columns for col in ["ebddiff"] + IMPACT_ITEMS[prefix or "p"])
+        }
+        if len(layouts) == 0:
+            return
 
+        # All informants are scored together, one row per respondent and informant
+        n = len(self.df)
+        difficulties = np.empty((n, len(layouts)))
+        impact = np.zeros((n, len(layouts), 5))
+        for i, (prefix, impact_items) in enumerate(layouts.items()):
+            difficulties[:, i] = self.df[prefix+"ebddiff"].to_numpy(dtype=float)
+            impact[:, i, :len(impact_items)] = self.df[[prefix+col for col in impact_items]].to_numpy(dtype=float)
+
+        scores = score_impact(difficulties.reshape(-1), impact.reshape(-1, 5))
+        self._set_columns([prefix+"impact" for prefix in layouts], scores.reshape(n, len(layouts)))
+
+    @stage("score")
     def score(self):
-        self._recode_inverse_items()
-        self._score()
+        # All informants are scored in one pass, one row per respondent and informant
+        n = len(self.df)
+        k = len(self.informants)
+        item_cols = [prefix+item for prefix in self.informants for item in ITEMS]
+        items = self.df[item_cols].to_numpy(dtype=float).reshape(n*k, len(ITEMS))
+
+        items, scores, n_missing = score_items(items)
+
+        self.df[item_cols] = items.reshape(n, k*len(ITEMS))
+        self._set_columns([prefix+score for prefix in self.informants for score in SCORES], scores.reshape(n, k*len(SCORES)))
+        self._score_impact()
 
         return self.df